@@ -0,0 +1,151 @@
+# batch.py
+#
+# Copyright 2021 Brice MARTIN
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Batch annotation of images from the command line:
+#
+#   imagine --batch recipe.json "screenshots/*.png" --output-dir annotated --workers 8
+#
+# A recipe is a JSON file describing the layers to stamp on every image:
+#
+#   {
+#       "layers": [
+#           {"type": "LineAnnotationLayer", "properties": {"color": "#ff0000", "width": 8, "arrow": true}, "anchors": [[100, 100], [300, 250]]},
+#           {"type": "BlurLayer", "properties": {"gaussian": 6.0}, "anchors": [[20, 20], [400, 60]]},
+#           {"type": "ZoomAnnotationLayer", "properties": {"zoom": 2.0}, "anchors": [[500, 300], [600, 360], [800, 500]]}
+#       ]
+#   }
+#
+# Layers are listed bottom to top, with the same specs as the project layers (see project.py): properties
+# are the GObject properties of the layer (colors are parsed by Gdk.RGBA, fonts are Pango descriptions,
+# selectors are one of their options), anchors are image coordinates in the order of the layer anchors,
+# and "state" holds the other layer data, such as the "points" of a path.
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from .document import Document
+from .project import get_layer_class, layer_from_spec
+
+def load_recipe(path):
+    with open(path) as f:
+        recipe = json.load(f)
+
+    # validate early, before spawning the workers
+    for spec in recipe.get("layers", []):
+        get_layer_class(spec["type"])
+
+    return recipe
+
+def annotate(recipe, input_path, output_path):
+    start = time.perf_counter()
+
+    document = Document(input_path, thumbnails=False, preview=False)
+
+    for spec in recipe.get("layers", []):
+        document.add_layer(layer_from_spec(document, spec))
+
+    document.save(output_path)
+
+    width, height = document.size
+    return time.perf_counter() - start, width * height
+
+def output_path_for(input_path, output_dir=None, suffix=None, format=None):
+    directory, filename = os.path.split(input_path)
+    name, extension = os.path.splitext(filename)
+
+    if output_dir != None:
+        directory = output_dir
+        if suffix == None: suffix = ""
+    elif suffix == None:
+        suffix = "_annotated"
+
+    if format != None:
+        extension = "." + format.lower()
+
+    return os.path.join(directory, name + suffix + extension)
+
+def expand_inputs(inputs):
+    paths = []
+    for pattern in inputs:
+        if glob.has_magic(pattern):
+            paths += sorted(glob.glob(pattern, recursive=True))
+        else:
+            paths.append(pattern)
+
+    # keep the order, without duplicates
+    return list(dict.fromkeys(paths))
+
+def run(argv):
+    parser = argparse.ArgumentParser(prog="imagine --batch", description="Annotate images in batch from a recipe.")
+    parser.add_argument("recipe", help="JSON annotation recipe")
+    parser.add_argument("inputs", nargs="+", help="input images or glob patterns")
+    parser.add_argument("-o", "--output-dir", help="output directory (default: next to the inputs)")
+    parser.add_argument("-s", "--suffix", help="suffix of the output file names (default: _annotated, none with --output-dir)")
+    parser.add_argument("-f", "--format", choices=["jpg", "jpeg", "png"], help="output format (default: the input format)")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="number of worker processes (default: number of CPUs)")
+    args = parser.parse_args(argv)
+
+    try:
+        recipe = load_recipe(args.recipe)
+    except (OSError, ValueError, KeyError) as e:
+        print("Invalid recipe %s: %s" % (args.recipe, e), file=sys.stderr)
+        return 2
+
+    inputs = expand_inputs(args.inputs)
+    if len(inputs) == 0:
+        print("No input images.", file=sys.stderr)
+        return 2
+
+    if args.output_dir != None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    rendered = 0
+    pixels = 0
+    failures = 0
+
+    with ProcessPoolExecutor(max_workers=max(args.workers, 1)) as executor:
+        futures = {}
+        for input_path in inputs:
+            output_path = output_path_for(input_path, args.output_dir, args.suffix, args.format)
+            futures[executor.submit(annotate, recipe, input_path, output_path)] = (input_path, output_path)
+
+        for future in as_completed(futures):
+            input_path, output_path = futures[future]
+            try:
+                elapsed, size = future.result()
+            except Exception as e:
+                failures += 1
+                print("%s: failed: %s" % (input_path, e), file=sys.stderr)
+                continue
+
+            rendered += 1
+            pixels += size
+            print("%s -> %s (%.3fs)" % (input_path, output_path, elapsed))
+
+    elapsed = time.perf_counter() - start
+    print("%d image(s) rendered in %.3fs with %d worker(s): %.2f images/s, %.2f Mpx/s%s" % (
+        rendered, elapsed, max(args.workers, 1),
+        rendered / elapsed if elapsed > 0 else 0,
+        pixels / elapsed / 1000000 if elapsed > 0 else 0,
+        ", %d failure(s)" % failures if failures > 0 else ""))
+
+    return 1 if failures > 0 else 0
@@ -18,19 +18,51 @@
 
 from PIL import Image
 import cairo
-from io import BytesIO
 from gi.repository import Gtk, Gio, GObject, GdkPixbuf, GLib
+from io import BytesIO
 import enum
 import os
+import math
+import shutil
+import subprocess
 from .extensions import *
+from .pixels import *
 from .layers import Layer
 from .history import *
+from .tiles import *
+
+# the composited area is aligned on this grid so that small scrolls keep the cache valid
+VIEWPORT_GRID = 256
+
+# documents from this number of pixels are rendered by tiles, within a fixed memory budget
+TILED_THRESHOLD = 64 * 1000 * 1000
+TILE_CACHE_BUDGET = 512 * 1024 * 1024
+
+# the regions read by the layers of tiled documents are only cached up to this fraction of the tiles budget
+SOURCE_BUDGET_FRACTION = 4
+
+# zoomed out documents are displayed from a downscaled level of the image (each level is half the previous one)
+PYRAMID_MAX_LEVEL = 5
+
+# size (in pixels) of the documents thumbnails
+THUMBNAIL_SIZE = 92
+
+# large JPEGs are first decoded at a reduced scale, down to this size (in pixels), enough to display them zoomed out
+PREVIEW_SIZE = 2048
 
 class LayerAction(enum.Enum):
     ADD = 1
     DELETE = 2
     MOVE = 3
 
+class LayerComposite:
+
+    def __init__(self, layer, key, bounds, surface):
+        self.layer = layer
+        self.key = key
+        self.bounds = bounds
+        self.surface = surface
+
 class Document(GObject.GObject):
 
     # callbacks
@@ -46,52 +78,189 @@ class Document(GObject.GObject):
     # dirty flag
     dirty = GObject.Property(type=bool, default=False)
 
+    # is the image still being decoded (see decode)?
+    loading = GObject.Property(type=bool, default=False)
+
     # history
     history = GObject.Property(type=History)
 
-    def __init__(self, path):
+    def __init__(self, path, image=None, thumbnails=True, preview=True, deferred=False, data=None, pixels=None):
         GObject.GObject.__init__(self)
 
         self.history = History()
         self.path = path
+        self.project_path = None
         self.name = os.path.basename(path)
         self.extension = os.path.splitext(path)[1]
-        self.image: Image = None
-        self._previous_layer_render: Image = None
+        self.pixels: PixelStore = None
+        self.orientation = Orientation()
+        self._previous_layer_surface: cairo.ImageSurface = None
+        self._previous_layer_origin = (0, 0)
+        self._previous_layer_level = 0
+        self._previous_layers = []
+        self._pixels_version = 0
+
+        # is the user interacting with the document (the layers may then trade quality for speed)?
+        self.interactive = False
+
         self.thumbnail: GdkPixbuf = None
-        self.imageSurface: cairo.ImageSurface = None
+        self._source_thumbnail: GdkPixbuf = None
+        self._thumbnails = thumbnails
+        self._preview = preview
+        self._thumbnail_version = 0
         self.layers = Gio.ListStore()
-        self._reload(Image.open(path))
+
+        # compositing cache: the render of the stack up to each enabled layer, bottom to top, within an area of the image
+        self._composites = []
+        self._composite_area = None
+        self.render_cache_hits = 0
+        self.render_cache_misses = 0
+        self.render_cache_invalidations = 0
+
+        # tiled rendering of very large images: base and composite tiles, and the stack they were rendered with
+        self.tiled = False
+        self._tiles = TileCache(TILE_CACHE_BUDGET)
+        self._tiled_layers = []
+
+        # pyramids: downscaled levels of the base image (tiled rendering) and of the composite
+        self._base_levels = {}
+        self._composite_levels = {}
+
+        # has the image itself been modified (crop, resize, rotation...)?
+        self.image_modified = False
+
+        # encoded image to decode instead of the file (embedded in a project)
+        self._data = data
+
+        # the image may be decoded later, away from the main thread
+        if pixels != None:
+            # shared with another document (read only)
+            self._set_pixels(None, pixels)
+        elif image != None:
+            self._reload(image)
+        elif deferred:
+            self.loading = True
+        else:
+            self._set_pixels(*self.decode())
 
         self.scroll_offset_x = 0
         self.scroll_offset_y = 0
 
-    def _reload(self, image, dirty=False):
-
-        # image
-        self.image = image
-
-        # thumbnail
-        thumbnail = self.image.copy()
-        thumbnail.thumbnail((92, 92), Image.ANTIALIAS)
+    def decode(self):
+        # (image, pixels) of the document file, on any thread (then handed to set_pixels on the main thread)
+        # large JPEGs are opened from a reduced preview, decoded at full resolution on first use
+        if self._data != None:
+            image = Image.open(BytesIO(self._data))
+            return image, self._create_pixels(image)
+
+        source = file_signature(self.path)
+        image, size, loader = open_image(self.path, PREVIEW_SIZE if self._preview else None)
+        return image, self._create_pixels(image, size, loader, source)
+
+    def set_pixels(self, image, pixels):
+        # (keeping the orientation given while decoding, by a project)
+        orientation = self.orientation
+        self._set_pixels(image, pixels)
+        self._data = None
+        self.set_orientation(orientation)
+        self.loading = False
+
+    def _create_pixels(self, image, size=None, loader=None, source=None):
+        # the pixels are kept a single time, as a cairo surface (very large images are converted by tiles, on demand)
+        # (decoded here, on the loader thread for the opened files: PIL opens them lazily)
+        image.load()
+        width, height = size if size != None else image.size
+        return PixelStore(image, surface=width * height < TILED_THRESHOLD, size=size, loader=loader, source=source)
 
-        p_buffer = BytesIO()
-        thumbnail.save(p_buffer, format="PNG")
-        p_buffer.seek(0)
+    def _reload(self, image, dirty=False):
+        self._set_pixels(image, self._create_pixels(image), dirty)
 
-        loader = GdkPixbuf.PixbufLoader()
-        loader.write(p_buffer.read())
-        self.thumbnail = loader.get_pixbuf()
-        loader.close()
+    def _set_pixels(self, image, pixels, dirty=False):
+        self.tiled = pixels.width * pixels.height >= TILED_THRESHOLD
+        self.pixels = pixels
+        self._pixels_version += 1
+        self.orientation = Orientation()
 
-        if self.on_updated_thumbnail != None:
-            self.on_updated_thumbnail(self)
+        # thumbnail, built in the background
+        if self._thumbnails and image != None:
+            self._thumbnail_version += 1
+            self._update_thumbnail(image, self._thumbnail_version)
 
-        # create cairo surface
-        self.imageSurface = cario_image_from_pil(self.image)
+        self._clear_caches()
 
         if dirty:
             self.dirty = True
+            self.image_modified = True
+
+    def _clear_caches(self):
+        # every cached composite is based on the previous image
+        self._composites = []
+        self._composite_area = None
+        self._previous_layer_surface = None
+        self._tiles.clear()
+        self._tiled_layers = []
+        self._base_levels = {}
+        self._composite_levels = {}
+
+    def evicted(self):
+        return self.pixels != None and self.pixels.evicted()
+
+    def evict(self):
+        # releases the decoded pixels and everything derived from them (decoded again on next use),
+        # returning the number of bytes freed
+        if self.loading or self.pixels == None:
+            return 0
+
+        freed = self.get_memory_bytes()
+        self.pixels.evict()
+        self._clear_caches()
+        for layer in self.layers:
+            layer.release_caches()
+        return freed - self.get_memory_bytes()
+
+    @threaded()
+    def _update_thumbnail(self, image, version):
+        thumbnail = thumbnail_from_pil(image, THUMBNAIL_SIZE)
+
+        # main thread, unless a newer thumbnail is on its way
+        def when_ready():
+            if version == self._thumbnail_version:
+                self._source_thumbnail = thumbnail
+                self._orient_thumbnail()
+
+        GLib.idle_add(when_ready)
+
+    def _orient_thumbnail(self):
+        if self._source_thumbnail != None:
+            self.thumbnail = self.orientation.transpose_pixbuf(self._source_thumbnail)
+            if self.on_updated_thumbnail != None:
+                self.on_updated_thumbnail(self)
+
+    @property
+    def size(self):
+        # size of the image as displayed (oriented)
+        return self.orientation.get_size(*self.pixels.size)
+
+    def get_image(self, rect=None, mode=None):
+        # the image as displayed (oriented), or a region of it
+        width, height = self.pixels.size
+        rect = self.orientation.unmap_rect(rect, width, height) if rect != None else None
+        return self.orientation.transpose(self.pixels.get_image(rect, mode))
+
+    def set_orientation(self, orientation):
+        # the pixels are left as they are, oriented when composited (and when exported)
+        self.orientation = orientation
+        self._clear_caches()
+        self._orient_thumbnail()
+
+    def _orient(self, orientation):
+        # the layers follow the image
+        width, height = self.size
+        for layer in self.layers:
+            layer.transform(orientation, width, height)
+
+        self.set_orientation(self.orientation.then(orientation))
+        self.dirty = True
 
     def rename(self, path):
         self.path = path
@@ -99,43 +268,62 @@ class Document(GObject.GObject):
         self.extension = os.path.splitext(path)[1]
 
     def resize(self, width, height):
-        # capture state for rollback
-        previous_image = self.image.copy()
+        # capture state for rollback (compressed, resizing is not invertible)
+        image = self.get_image()
+        previous = PixelData(image)
 
-        self.history.snapshot("Resize to (%d, %d)" % (width, height), lambda: self._reload(previous_image, dirty=True))
+        self.history.snapshot("Resize to (%d, %d)" % (width, height), lambda: self._reload(previous.get_image(), dirty=True), [previous])
 
-        self._reload(self.image.resize((width, height), resample=Image.BILINEAR), dirty=True)
+        self._reload(image.resize((width, height), resample=Image.BILINEAR), dirty=True)
 
     def crop(self, x1, y1, x2, y2):
 
-        # capture state for rollback
-        previous_image = self.image.copy()
+        # capture state for rollback: only the borders cut away, the rest of the image is the cropped one
+        image = self.get_image()
+        mode, (width, height) = image.mode, image.size
+        bx1, by1, bx2, by2 = [int(round(v)) for v in (x1, y1, x2, y2)]
+        borders = [(0, 0, width, by1), (0, by2, width, height), (0, by1, bx1, by2), (bx2, by1, width, by2)]
+        borders = [PixelData(image, box) for box in [intersect_rect(box, (0, 0, width, height)) for box in borders] if box != None]
         previous_layers = self.layers
 
+        # (the rollback must not hold the uncropped image)
         def do_rollback():
-            self._reload(previous_image, dirty=True)
+            restored = Image.new(mode, (width, height))
+            restored.paste(self.get_image(), (bx1, by1))
+            for border in borders:
+                restored.paste(border.get_image(), border.origin)
+
+            self._reload(restored, dirty=True)
             for layer in previous_layers:
                 layer.crop(-x1, -y1)
 
-        self.history.snapshot("Cropping", do_rollback)
+        self.history.snapshot("Cropping", do_rollback, borders)
 
-        self._reload(self.image.crop((x1, y1, x2, y2)), dirty=True)
+        self._reload(image.crop((bx1, by1, bx2, by2)), dirty=True)
         for layer in self.layers:
             layer.crop(x1, y1)
 
     def rotate(self, angle):
         self.history.snapshot("Rotation of %d°" % angle, lambda: self.rotate(-angle))
-        self._reload(self.image.rotate(angle, expand=True), dirty=True)
+
+        # quarter turns (counterclockwise) are only an orientation of the pixels
+        if angle % 90 == 0:
+            orientation = Orientation()
+            for _ in range((angle // 90) % 4):
+                orientation = orientation.then(Orientation.from_name("ROTATE_90"))
+            self._orient(orientation)
+        else:
+            self._reload(self.get_image().rotate(angle, expand=True), dirty=True)
 
     def flip_horizontal(self):
         self.history.snapshot("Horizontal flip", lambda: self.flip_horizontal())
-        self._reload(self.image.transpose(Image.FLIP_LEFT_RIGHT), dirty=True)
+        self._orient(Orientation.from_name("FLIP_LEFT_RIGHT"))
 
     def flip_vertical(self):
         self.history.snapshot("Vertical flip", lambda: self.flip_vertical())
-        self._reload(self.image.transpose(Image.FLIP_TOP_BOTTOM), dirty=True)
+        self._orient(Orientation.from_name("FLIP_TOP_BOTTOM"))
 
-    def add_layer(self, layer):
+    def _watch_layer(self, layer):
 
         def when_layer_added():
             self.history.snapshot("Add %s" % layer.name, lambda: self.delete_layer(layer))
@@ -144,6 +332,9 @@ class Document(GObject.GObject):
         if not layer.transient:
             layer.connect("notify::dirty", lambda _, __: when_layer_added())
 
+    def add_layer(self, layer):
+        self._watch_layer(layer)
+
         self.layers.insert(0, layer)
 
         self._update_layers_position()
@@ -151,6 +342,18 @@ class Document(GObject.GObject):
         if self.on_updated_layers_list != None:
             self.on_updated_layers_list(LayerAction.ADD, layer)
 
+    def load_layers(self, layers):
+        # add a whole stack at once (bottom to top), notifying a single time
+        for layer in layers:
+            self._watch_layer(layer)
+
+        self.layers.splice(0, 0, list(reversed(layers)))
+
+        self._update_layers_position()
+
+        if self.on_updated_layers_list != None:
+            self.on_updated_layers_list(LayerAction.ADD, layers[-1] if len(layers) > 0 else None)
+
     def index_of_layer(self, layer):
         for i, l in enumerate(self.layers):
             if l == layer:
@@ -193,8 +396,79 @@ class Document(GObject.GObject):
         for i, l in enumerate(self.layers):
             l.position = i
 
-    def get_previous_render(self):
-        return self._previous_layer_render if self._previous_layer_render != None else self.image
+    def get_previous_render(self, rect=None):
+        x1, y1, x2, y2 = rect if rect != None else self._get_image_rect()
+
+        # outside of the tiled compositing, the requested region is rendered on demand
+        if self._previous_layer_surface == None and self.tiled:
+            area = intersect_rect(align_rect((x1, y1, x2, y2)), self._get_image_rect()) or (0, 0, 1, 1)
+            surface, origin = self._render_area(None, area, 0, 0)
+            self._previous_layer_surface = None
+            return pil_from_cairo(surface, rect=(x1 - origin[0], y1 - origin[1], x2 - origin[0], y2 - origin[1]))
+
+        if self._previous_layer_surface == None:
+            return self.get_image(rect, 'RGB')
+
+        # only the requested region of the render below the current layer is converted
+        ox, oy = self._previous_layer_origin
+        f = 1 << self._previous_layer_level
+        image = pil_from_cairo(self._previous_layer_surface, rect=(x1 / f - ox, y1 / f - oy, x2 / f - ox, y2 / f - oy))
+
+        # the layers always work on full resolution pixels
+        if f > 1:
+            image = image.resize((max(int(round(x2)) - int(round(x1)), 1), max(int(round(y2)) - int(round(y1)), 1)), Image.BILINEAR)
+
+        return image
+
+    def get_previous_render_pattern(self, rect=None):
+        # the render below the current layer, as a pattern in image coordinates sampling its surface in place
+        # (the rect is only used when there is no such surface and the region has to be rendered)
+        if self._previous_layer_surface == None:
+            x1, y1, x2, y2 = rect if rect != None else self._get_image_rect()
+            surface, origin, f = cairo_from_pil(self.get_previous_render((x1, y1, x2, y2))), (int(round(x1)), int(round(y1))), 1
+        else:
+            surface, origin, f = self._previous_layer_surface, self._previous_layer_origin, 1 << self._previous_layer_level
+
+        pattern = cairo.SurfacePattern(surface)
+        pattern.set_matrix(cairo.Matrix(1 / f, 0, 0, 1 / f, -origin[0], -origin[1]))
+        pattern.set_filter(cairo.FILTER_GOOD)
+        return pattern
+
+    def get_previous_render_coverage(self, rect):
+        # part of the rect actually rendered below the current layer (get_previous_render fills the rest with black)
+        covered = self._get_image_rect()
+        if self._previous_layer_surface != None:
+            ox, oy = self._previous_layer_origin
+            f = 1 << self._previous_layer_level
+            surface = self._previous_layer_surface
+            covered = intersect_rect(covered, (ox * f, oy * f, (ox + surface.get_width()) * f, (oy + surface.get_height()) * f))
+        return intersect_rect(rect, covered)
+
+    def get_previous_render_key(self):
+        # identifies the pixels returned by get_previous_render: what they are rendered from
+        if self._previous_layer_surface != None:
+            layers, level = self._previous_layers, self._previous_layer_level
+        else:
+            layers, level = [layer for layer in reversed(self.layers) if layer.enabled] if self.tiled else [], 0
+        return self._pixels_version, self.orientation, level, tuple((layer, layer.get_render_key()) for layer in layers)
+
+    def get_pyramid_level(self, scale=None):
+        # the smallest level still larger than the displayed image
+        scale = self.scale if scale == None else scale
+        if scale <= 0 or scale >= 100:
+            return 0
+        return min(int(math.floor(math.log2(100 / scale))), PYRAMID_MAX_LEVEL)
+
+    def _get_base_level(self, level):
+        # (not oriented)
+        image = self.pixels.get_image()
+        if level == 0:
+            return image
+
+        if level not in self._base_levels:
+            f = 1 << level
+            self._base_levels[level] = image.reduce(f) if image.width >= f and image.height >= f else image
+        return self._base_levels[level]
 
     def get_layers_at_position(self, x, y):
         return [layer for layer in self.layers if layer.enabled and layer.hit_test(x, y)]
@@ -202,45 +476,556 @@ class Document(GObject.GObject):
     def get_layers_positions_at_position(self, x, y):
         return [layer.position for layer in self.get_layers_at_position(x, y)]
 
-    def draw(self, w, cr, mouse_x, mouse_y, helpers=False):
+    def get_render_cache_stats(self):
+        return {
+            "hits": self.render_cache_hits,
+            "misses": self.render_cache_misses,
+            "invalidations": self.render_cache_invalidations,
+            "cached": len(self._composites),
+        }
+
+    def get_filter_cache_stats(self):
+        # results cached by the filter layers
+        stats = {"layers": 0, "results": 0, "bytes": 0, "hits": 0, "misses": 0, "evictions": 0}
+        for layer in self.layers:
+            if hasattr(layer, "get_result_cache_stats"):
+                layer_stats = layer.get_result_cache_stats()
+                stats["layers"] += 1
+                stats["results"] += layer_stats["tiles"]
+                for name in ("bytes", "hits", "misses", "evictions"):
+                    stats[name] += layer_stats[name]
+        return stats
+
+    def get_memory_stats(self):
+        # bytes held by the document: its pixels, and the caches derived from them
+        composites = sum(surface_bytes(c.surface) for c in self._composites if c.surface != None)
+        levels = sum(surface_bytes(surface) for surface in self._composite_levels.values())
+        levels += sum(image_bytes(image) for image in self._base_levels.values())
+        return {
+            "pixels": self.pixels.get_bytes() if self.pixels != None else 0,
+            "composites": composites,
+            "levels": levels,
+            "tiles": self._tiles.size,
+            "history": self.history.get_bytes(),
+            "layers": sum(layer.get_cache_bytes() for layer in self.layers),
+        }
+
+    def get_memory_bytes(self):
+        return sum(self.get_memory_stats().values())
+
+    def get_evictable_bytes(self):
+        # bytes evict may release: the history is bounded by its own budgets, spilling its older snapshots
+        stats = self.get_memory_stats()
+        return sum(stats.values()) - stats["history"]
+
+    def _get_image_rect(self):
+        width, height = self.size
+        return 0, 0, width, height
+
+    def _get_composite_area(self, viewport, layers):
+        image_rect = self._get_image_rect()
+        if viewport == None:
+            return image_rect
+
+        # layers displayed in the viewport may read pixels outside of it (from the top of the stack)
+        area = viewport
+        for layer, _, bounds, _ in reversed(layers):
+            if layer.READS_PREVIOUS_RENDER and intersect_rect(bounds, area) != None:
+                area = union_rect(area, layer.get_source_bounds())
+
+        x1, y1, x2, y2 = area
+        area = (math.floor(x1 / VIEWPORT_GRID) * VIEWPORT_GRID, math.floor(y1 / VIEWPORT_GRID) * VIEWPORT_GRID,
+                math.ceil(x2 / VIEWPORT_GRID) * VIEWPORT_GRID, math.ceil(y2 / VIEWPORT_GRID) * VIEWPORT_GRID)
+
+        return intersect_rect(area, image_rect) or image_rect
+
+    def _plan_composites(self, viewport=None):
+        layers = []
+
+        # layers, from the bottom of the stack (disabled layers won't render)
+        for i, layer in enumerate([layer for layer in reversed(self.layers) if layer.enabled]):
+            key = layer.get_render_key()
+            cached = self._composites[i] if i < len(self._composites) else None
+            bounds = cached.bounds if cached != None and cached.layer == layer and cached.key == key else layer.get_bounds()
+            layers.append((layer, key, bounds, cached))
+
+        composite_area = self._get_composite_area(viewport, layers)
+
+        plan = []
+        damage = None
+        full = composite_area != self._composite_area
+
+        for layer, key, bounds, cached in layers:
+
+            if full or cached == None or cached.layer != layer:
+                # new, moved or toggled layer: the whole stack above is composited again
+                full = True
+            elif cached.key != key:
+                # modified layer: both its previous and its new areas are damaged
+                damage = union_rect(damage, union_rect(cached.bounds, bounds))
+            elif damage != None and layer.READS_PREVIOUS_RENDER and intersect_rect(layer.get_source_bounds(), damage) != None:
+                # a layer reading damaged pixels renders differently as well
+                damage = union_rect(damage, bounds)
+
+            area = composite_area if full else intersect_rect(align_rect(damage), composite_area)
+            plan.append((layer, key, bounds, cached, area))
+
+        # removed layers only damage the screen
+        for cached in self._composites[len(plan):]:
+            damage = union_rect(damage, cached.bounds)
+
+        return plan, composite_area, composite_area if full else intersect_rect(align_rect(damage), composite_area)
+
+    def get_damaged_area(self, viewport=None):
+        # area of the image which will change on the next draw
+        if self.tiled:
+            return self._get_tiles_damage(self._get_tiled_layers())
+
+        _, _, damage = self._plan_composites(viewport)
+        return damage
+
+    def _composite_layers(self, w, mouse_x, mouse_y, viewport=None):
+        plan, composite_area, damage = self._plan_composites(viewport)
+        ax1, ay1, ax2, ay2 = composite_area
 
         # starting point is the image itself
-        previous_back_layer = self.imageSurface
-        self._previous_layer_render = pil_from_cairo_surface(self.imageSurface)
-        cr.set_source_surface(self.imageSurface, 0, 0)
-        cr.paint()
+        previous_back_layer, previous_origin = self._get_base_surface(composite_area)
+        composites = []
+        invalidated = len(plan) < len(self._composites)
+
+        for i, (layer, key, bounds, cached, area) in enumerate(plan):
+
+            # reuse the cached composite as long as nothing changed below and in the layer itself
+            if area == None:
+                self.render_cache_hits += 1
+                composites.append(cached)
+                previous_back_layer = cached.surface
+                previous_origin = (ax1, ay1)
+                continue
 
-        # layers
-        for layer in reversed(self.layers):
+            # everything above the lowest modified layer has to be composited again, within the damaged area
+            invalidated = invalidated or cached != None
+            self.render_cache_misses += 1
 
-            # disabled layer won't render
-            if not layer.enabled:
-                continue
+            # intermediary surface covering the composited area, reused when possible
+            if cached != None and cached.surface.get_width() == ax2 - ax1 and cached.surface.get_height() == ay2 - ay1:
+                layer_surface = cached.surface
+            else:
+                layer_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, ax2 - ax1, ay2 - ay1)
 
-            # create intermediary surface
-            layer_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.imageSurface.get_width(), self.imageSurface.get_height())
+            # layers keep drawing in image coordinates
             layer_context = cairo.Context(layer_surface)
+            layer_context.translate(-ax1, -ay1)
+            x1, y1, x2, y2 = area
+            layer_context.rectangle(x1, y1, x2 - x1, y2 - y1)
+            layer_context.clip()
 
             # render previous layer
-            layer_context.set_source_surface(previous_back_layer, 0, 0)
+            if layer.READS_PREVIOUS_RENDER:
+                self._previous_layer_surface = previous_back_layer
+                self._previous_layer_origin = previous_origin
+                self._previous_layer_level = 0
+                self._previous_layers = [p[0] for p in plan[:i]]
+            layer_context.set_operator(cairo.OPERATOR_SOURCE)
+            layer_context.set_source_surface(previous_back_layer, previous_origin[0], previous_origin[1])
             layer_context.paint()
+            layer_context.set_operator(cairo.OPERATOR_OVER)
 
             # render layer
             layer_context.save()
             layer.draw(w, layer_context, mouse_x, mouse_y)
             layer_context.restore()
+            layer_surface.flush()
 
             # save intermediary render for the next layers
+            composites.append(LayerComposite(layer, key, bounds, layer_surface))
             previous_back_layer = layer_surface
-            self._previous_layer_render = pil_from_cairo_surface(layer_surface)
+            previous_origin = (ax1, ay1)
+
+        if invalidated:
+            self.render_cache_invalidations += 1
+
+        # keep the downscaled levels of the composite in sync
+        if composite_area != self._composite_area:
+            self._composite_levels = {}
+        elif damage != None:
+            for level, level_surface in self._composite_levels.items():
+                self._downscale_composite(previous_back_layer, previous_origin, level_surface, level, damage)
+
+        self._composites = composites
+        self._composite_area = composite_area
+
+        # the previous render is the whole stack outside of the compositing
+        self._previous_layer_surface = previous_back_layer
+        self._previous_layer_origin = previous_origin
+        self._previous_layer_level = 0
+        self._previous_layers = [p[0] for p in plan]
+
+        return previous_back_layer, previous_origin
+
+    def _downscale_composite(self, surface, origin, level_surface, level, area=None):
+        f = 1 << level
+        ax1, ay1, _, _ = self._composite_area
+
+        context = cairo.Context(level_surface)
+        context.scale(1 / f, 1 / f)
+        context.translate(-ax1, -ay1)
+
+        # only the level pixels covering the area
+        if area != None:
+            x1, y1, x2, y2 = area
+            x1, y1, x2, y2 = (x1 // f) * f, (y1 // f) * f, -(-x2 // f) * f, -(-y2 // f) * f
+            context.rectangle(x1, y1, x2 - x1, y2 - y1)
+            context.clip()
+
+        context.set_operator(cairo.OPERATOR_SOURCE)
+        context.set_source_surface(surface, origin[0], origin[1])
+        context.get_source().set_filter(cairo.FILTER_GOOD)
+        context.paint()
+        level_surface.flush()
+
+    def _get_composite_level(self, surface, origin, level):
+        # level covering the composited area
+        if level not in self._composite_levels:
+            f = 1 << level
+            ax1, ay1, ax2, ay2 = self._composite_area
+            level_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, -(-(ax2 - ax1) // f), -(-(ay2 - ay1) // f))
+            self._downscale_composite(surface, origin, level_surface, level)
+            self._composite_levels[level] = level_surface
+        return self._composite_levels[level]
+
+    def _get_base_surface(self, area, level=0, tiles=None):
+        if not self.tiled and self.orientation.is_identity():
+            return self.pixels.get_surface(), (0, 0)
+
+        x1, y1, x2, y2 = area
+
+        if not self.tiled:
+            # oriented when composited, only within the area
+            source = self.pixels.get_surface()
+            surface = cairo.ImageSurface(source.get_format(), x2 - x1, y2 - y1)
+            context = cairo.Context(surface)
+            context.translate(-x1, -y1)
+            context.transform(self.orientation.get_matrix(source.get_width(), source.get_height()))
+            context.set_source_surface(source, 0, 0)
+            context.get_source().set_filter(cairo.FILTER_NEAREST)
+            context.paint()
+            surface.flush()
+            return surface, (x1, y1)
+
+        # assemble the base image (area in level coordinates) from its tiles
+        tiles = self._tiles if tiles == None else tiles
+        image = self._get_base_level(level)
+        width, height = self.orientation.get_size(*image.size)
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, x2 - x1, y2 - y1)
+        context = cairo.Context(surface)
+        context.translate(-x1, -y1)
+
+        for tx, ty in tiles_in_rect(area, width, height):
+            key = ("base", level, tx, ty)
+            tile = tiles.get(key)
+            rect = tile_rect(tx, ty, width, height)
+
+            if tile == None:
+                tile = cairo_from_pil(self.orientation.transpose(image.crop(self.orientation.unmap_rect(rect, *image.size))))
+                tiles.put(key, tile)
+
+            context.set_source_surface(tile, rect[0], rect[1])
+            context.paint()
+
+        surface.flush()
+        return surface, (x1, y1)
+
+    def _render_area(self, w, area, mouse_x, mouse_y, level=0, tiles=None, layers=None):
+        # composite the stack (or its given bottom layers) within an area, without keeping the intermediate
+        # renders (the base tiles and the regions read by the layers are kept in the tiles cache)
+        f = 1 << level
+        x1, y1, x2, y2 = area
+        x1, y1, x2, y2 = x1 // f, y1 // f, -(-x2 // f), -(-y2 // f)
+        previous_back_layer, previous_origin = self._get_base_surface((x1, y1, x2, y2), level, tiles)
+        surfaces = [None, None]
+        layers = [layer for layer in reversed(self.layers) if layer.enabled] if layers == None else layers
+
+        for i, layer in enumerate(layers):
+
+            # two intermediary surfaces are enough, each layer reading the other one
+            if surfaces[i % 2] == None:
+                surfaces[i % 2] = cairo.ImageSurface(cairo.FORMAT_ARGB32, x2 - x1, y2 - y1)
+            layer_surface = surfaces[i % 2]
+
+            layer_context = cairo.Context(layer_surface)
+            layer_context.translate(-x1, -y1)
+
+            # render previous layer (tiles read the whole region a layer depends on, rendered once for all of them)
+            if layer.READS_PREVIOUS_RENDER:
+                source = self._get_source_surface(w, layers, i, mouse_x, mouse_y, level, tiles) if self.tiled else None
+                self._previous_layer_surface, self._previous_layer_origin = source if source != None else (previous_back_layer, previous_origin)
+                self._previous_layer_level = level
+                self._previous_layers = layers[:i]
+            layer_context.set_operator(cairo.OPERATOR_SOURCE)
+            layer_context.set_source_surface(previous_back_layer, previous_origin[0], previous_origin[1])
+            layer_context.paint()
+            layer_context.set_operator(cairo.OPERATOR_OVER)
 
-            # render the layer helpers
+            # render layer (in image coordinates)
             layer_context.save()
-            if helpers:
-                layer.draw_helpers(w, layer_context, mouse_x, mouse_y)
+            layer_context.scale(1 / f, 1 / f)
+            layer.draw(w, layer_context, mouse_x, mouse_y)
             layer_context.restore()
+            layer_surface.flush()
 
-            # render the layer on top of the other ones
-            cr.set_source_surface(layer_surface, 0, 0)
+            previous_back_layer = layer_surface
+            previous_origin = (x1, y1)
+
+        return previous_back_layer, previous_origin
+
+    def _get_source_surface(self, w, layers, i, mouse_x, mouse_y, level, tiles=None):
+        # (surface, origin) of the render below a layer, within the whole region it reads (cached by tiles,
+        # as long as it fits in a fraction of their budget)
+        tiles = self._tiles if tiles == None else tiles
+        area = intersect_rect(align_rect(layers[i].get_source_bounds()), self._get_image_rect())
+        if area == None:
+            return None
+
+        f = 1 << level
+        origin = (area[0] // f, area[1] // f)
+        key = ("source", level, self._pixels_version, self.orientation, area, tuple((layer, layer.get_render_key()) for layer in layers[:i]))
+        surface = tiles.get(key)
+
+        if surface == None:
+            surface, origin = self._render_area(w, area, mouse_x, mouse_y, level, tiles, layers[:i])
+            if surface_bytes(surface) <= tiles.budget // SOURCE_BUDGET_FRACTION:
+                tiles.put(key, surface)
+
+        return surface, origin
+
+    def _get_tiled_layers(self):
+        layers = []
+
+        # layers, from the bottom of the stack, reusing the bounds of the unmodified layers
+        for i, layer in enumerate([layer for layer in reversed(self.layers) if layer.enabled]):
+            key = layer.get_render_key()
+            previous = self._tiled_layers[i] if i < len(self._tiled_layers) else None
+            bounds = previous[2] if previous != None and previous[0] == layer and previous[1] == key else layer.get_bounds()
+            layers.append((layer, key, bounds))
+
+        return layers
+
+    def _get_tiles_damage(self, layers):
+        damage = None
+        changed = False
+
+        for i, (layer, key, bounds) in enumerate(layers):
+            previous = self._tiled_layers[i] if i < len(self._tiled_layers) else None
+
+            if changed or previous == None or previous[0] != layer:
+                # new, moved or toggled layer: the stack above only changes where its layers render
+                changed = True
+                damage = union_rect(damage, union_rect(previous[2] if previous != None else None, bounds))
+            elif previous[1] != key:
+                damage = union_rect(damage, union_rect(previous[2], bounds))
+            elif damage != None and layer.READS_PREVIOUS_RENDER and intersect_rect(layer.get_source_bounds(), damage) != None:
+                damage = union_rect(damage, bounds)
+
+        # removed layers
+        for previous in self._tiled_layers[len(layers):]:
+            damage = union_rect(damage, previous[2])
+
+        return intersect_rect(align_rect(damage), self._get_image_rect())
+
+    def _get_composite_tile(self, w, level, tx, ty, layers, mouse_x, mouse_y):
+        key = ("composite", level, tx, ty)
+        tile = self._tiles.get(key)
+
+        if tile == None:
+            f = 1 << level
+            width, height = self.size
+            rect = tile_rect(tx, ty, width, height, TILE_SIZE * f)
+
+            # (the pixels read outside of it by the zoom, clone... layers are rendered once for all the tiles)
+            surface, origin = self._render_area(w, rect, mouse_x, mouse_y, level)
+
+            tile = cairo.ImageSurface(cairo.FORMAT_ARGB32, -(-(rect[2] - rect[0]) // f), -(-(rect[3] - rect[1]) // f))
+            context = cairo.Context(tile)
+            context.set_operator(cairo.OPERATOR_SOURCE)
+            context.set_source_surface(surface, origin[0] - rect[0] // f, origin[1] - rect[1] // f)
+            context.paint()
+            tile.flush()
+
+            self._tiles.put(key, tile)
+
+        return tile
+
+    def _draw_tiles(self, w, cr, mouse_x, mouse_y, viewport, level, filter):
+
+        # discard the composite tiles (of every level) damaged since the last draw
+        width, height = self.size
+        layers = self._get_tiled_layers()
+        damage = self._get_tiles_damage(layers)
+        if damage != None:
+            self._tiles.remove_if(lambda key: key[0] == "composite" and intersect_rect(tile_rect(key[2], key[3], width, height, TILE_SIZE << key[1]), damage) != None)
+        self._tiled_layers = layers
+
+        # only the tiles of the viewport (and of the exposed area) are rendered
+        f = 1 << level
+        rect = intersect_rect(viewport if viewport != None else self._get_image_rect(), self._get_image_rect())
+        rect = intersect_rect(rect, cr.clip_extents())
+
+        if rect != None:
+            for tx, ty in tiles_in_rect(rect, width, height, TILE_SIZE * f):
+                tile = self._get_composite_tile(w, level, tx, ty, layers, mouse_x, mouse_y)
+                x1, y1, x2, y2 = tile_rect(tx, ty, width, height, TILE_SIZE * f)
+
+                cr.save()
+                cr.rectangle(x1, y1, x2 - x1, y2 - y1)
+                cr.clip()
+                cr.translate(x1, y1)
+                cr.scale(f, f)
+                cr.set_source_surface(tile, 0, 0)
+                cr.get_source().set_filter(filter)
+                cr.paint()
+                cr.restore()
+
+        # the previous render is rendered on demand outside of the compositing
+        self._previous_layer_surface = None
+
+    def get_tile_cache_stats(self):
+        return self._tiles.get_stats()
+
+    def draw(self, w, cr, mouse_x, mouse_y, helpers=False, viewport=None, level=0, filter=cairo.FILTER_GOOD, interactive=False):
+        self.interactive = interactive
+
+        # a document still displayed as opened, zoomed out, doesn't need its full resolution pixels yet
+        preview = self.pixels.get_preview_surface(level) if not any(layer.enabled for layer in self.layers) else None
+
+        # render the whole stack (or the part of it displayed in the viewport), from a pyramid level when zoomed out
+        if preview != None:
+            cr.save()
+            cr.transform(self.orientation.get_matrix(self.pixels.width, self.pixels.height))
+            cr.scale(self.pixels.width / preview.get_width(), self.pixels.height / preview.get_height())
+            cr.set_source_surface(preview, 0, 0)
+            cr.get_source().set_filter(filter)
             cr.paint()
-
+            cr.restore()
+        elif self.tiled:
+            self._draw_tiles(w, cr, mouse_x, mouse_y, viewport, level, filter)
+        else:
+            surface, origin = self._composite_layers(w, mouse_x, mouse_y, viewport)
+
+            cr.save()
+            if level > 0:
+                cr.translate(self._composite_area[0], self._composite_area[1])
+                cr.scale(1 << level, 1 << level)
+                cr.set_source_surface(self._get_composite_level(surface, origin, level), 0, 0)
+            else:
+                cr.set_source_surface(surface, origin[0], origin[1])
+            cr.get_source().set_filter(filter)
+            cr.paint()
+            cr.restore()
+
+        # render the layers helpers on top of the other ones
+        if helpers:
+            for layer in reversed(self.layers):
+                if layer.enabled:
+                    cr.save()
+                    layer.draw_helpers(w, cr, mouse_x, mouse_y)
+                    cr.restore()
+
+    def render(self):
+        # full resolution render of the layers stack, without helpers (no window needed)
+        # the intermediate renders are not kept and the display caches are left untouched
+        # (always in the layers best quality)
+        interactive, self.interactive = self.interactive, False
+        try:
+            if self.tiled:
+                surface = self._render_tiles()
+            else:
+                surface, _ = self._render_area(None, self._get_image_rect(), 0, 0)
+        finally:
+            self.interactive = interactive
+        self._previous_layer_surface = None
+        return surface
+
+    def _render_tiles(self):
+        # very large images are rendered tile by tile into the output, only a tile being composited at a
+        # time, with a tiles cache of its own (the display one is left as it is)
+        width, height = self.size
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        context = cairo.Context(surface)
+        context.set_operator(cairo.OPERATOR_SOURCE)
+        tiles = TileCache(TILE_CACHE_BUDGET)
+
+        for tx, ty in tiles_in_rect(self._get_image_rect(), width, height):
+            x1, y1, x2, y2 = tile_rect(tx, ty, width, height)
+            tile, origin = self._render_area(None, (x1, y1, x2, y2), 0, 0, tiles=tiles)
+
+            context.save()
+            context.rectangle(x1, y1, x2 - x1, y2 - y1)
+            context.clip()
+            context.set_source_surface(tile, origin[0], origin[1])
+            context.paint()
+            context.restore()
+
+        surface.flush()
+        return surface
+
+    def _save_lossless_jpeg(self, path, source):
+        # an unmodified JPEG, maybe oriented, is transformed without being decoded (by jpegtran, if installed)
+        if source == None or self.image_modified or any(layer.enabled for layer in self.layers):
+            return False
+        if os.path.splitext(source[0])[1].lower() not in (".jpg", ".jpeg") or file_signature(source[0]) != source:
+            return False
+
+        jpegtran = shutil.which("jpegtran")
+        if jpegtran == None:
+            return False
+
+        # (perfect transformations only: the partial edge blocks of some sizes would be trimmed)
+        result = subprocess.run([jpegtran, "-copy", "all", "-perfect"] + self.orientation.get_jpegtran_args() + [source[0]], capture_output=True)
+        if result.returncode != 0:
+            return False
+
+        with open(path, "wb") as f:
+            f.write(result.stdout)
+        return True
+
+    def save(self, path=None):
+        path = self.path if path == None else path
+        extension = os.path.splitext(path)[1].lower()
+
+        # the pixels can't be decoded from a file which is being overwritten (with the orientation applied)
+        source = self.pixels.source
+        if source != None and os.path.abspath(source[0]) == os.path.abspath(path):
+            self.pixels.detach()
+
+        def save_png():
+            # the same pixels, seen without alpha (as flattened on black)
+            surface = self.render()
+            width, height, stride = surface.get_width(), surface.get_height(), surface.get_stride()
+            cairo.ImageSurface.create_for_data(surface.get_data(), cairo.FORMAT_RGB24, width, height, stride).write_to_png(path)
+
+        def save_jpg():
+            if self._save_lossless_jpeg(path, source):
+                return
+
+            # only oriented: losslessly transposed, else a single conversion of the render (released before encoding)
+            if not any(layer.enabled for layer in self.layers) and self.pixels.mode == 'RGB':
+                image = self.get_image()
+            else:
+                image = pil_from_cairo(self.render())
+            image.save(path, quality=90)
+
+        switcher = {
+            ".jpg": save_jpg,
+            ".jpeg": save_jpg,
+            ".png": save_png
+        }
+
+        saver = switcher.get(extension)
+        if saver == None:
+            raise ValueError("Unsupported file format: %s" % extension)
+
+        saver()
+
+        if path == self.path:
+            self.dirty = False
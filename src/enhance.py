@@ -0,0 +1,136 @@
+# enhance.py
+#
+# Copyright 2021 Brice MARTIN
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Fused lighting enhancement: brightness, contrast, sharpness and color (saturation).
+#
+# The ImageEnhance chain blends each step with a degenerate image (black, mean gray, smoothed, grayscale).
+# Brightness, contrast and color are affine per pixel, and sharpness is a convolution whose weights sum to
+# one (it commutes with them), so the whole chain is a single 3x4 color matrix (Image.convert) followed by
+# a single 3x3 kernel (Image.filter), both run by PIL in C without the GIL. Large regions are processed by
+# horizontal strips (overlapping by a row for the kernel) on a thread pool.
+#
+# The only differences with the chain come from its intermediate roundings and clippings: a few levels on
+# average, more where a step saturates channels that a later one brings back (see compare).
+
+from PIL import Image, ImageChops, ImageEnhance, ImageFilter, ImageStat
+from concurrent.futures import ThreadPoolExecutor
+import os
+import timeit
+
+__all__ = ['enhance', 'enhance_reference']
+
+# threads processing the strips of a region, and their minimal height
+ENHANCE_WORKERS = os.cpu_count() or 1
+STRIP_HEIGHT = 128
+
+# luma weights of PIL (L conversion), used by the contrast and the color enhancements
+LUMA = (0.299, 0.587, 0.114)
+
+# smoothing kernel of ImageEnhance.Sharpness (ImageFilter.SMOOTH)
+SMOOTH = (1, 1, 1, 1, 5, 1, 1, 1, 1)
+SMOOTH_SCALE = 13
+
+_executor = None
+
+def _get_executor():
+    global _executor
+    if _executor == None:
+        _executor = ThreadPoolExecutor(max_workers=ENHANCE_WORKERS, thread_name_prefix="enhance")
+    return _executor
+
+def _mean_luma(image, brightness):
+    # mean gray of the brightened image (clipped as the brightness step does)
+    histogram = image.convert('L').histogram()
+    total = sum(histogram)
+    return int(sum(min(v * brightness, 255) * n for v, n in enumerate(histogram)) / total + 0.5) if total > 0 else 0
+
+def _color_matrix(brightness, contrast, color, mean):
+    # brightness: b.x, contrast: c.x + (1 - c).mean, color: s.x + (1 - s).luma(x)
+    matrix = []
+    for i in range(3):
+        for j in range(3):
+            matrix.append(contrast * brightness * (color * (i == j) + (1 - color) * LUMA[j]))
+        matrix.append((1 - contrast) * mean)
+    return tuple(matrix)
+
+def _sharpness_kernel(sharpness):
+    # s.x + (1 - s).smooth(x)
+    weights = [(1 - sharpness) * w / SMOOTH_SCALE for w in SMOOTH]
+    weights[4] += sharpness
+    return ImageFilter.Kernel((3, 3), weights, scale=1)
+
+def enhance(image, brightness=1.0, contrast=1.0, sharpness=1.0, color=1.0):
+    image = image if image.mode == 'RGB' else image.convert('RGB')
+    width, height = image.size
+
+    mean = _mean_luma(image, brightness) if contrast != 1.0 else 0
+    matrix = _color_matrix(brightness, contrast, color, mean) if (brightness, contrast, color) != (1.0, 1.0, 1.0) else None
+    kernel = _sharpness_kernel(sharpness) if sharpness != 1.0 and width >= 3 and height >= 3 else None
+
+    def process(region):
+        if matrix != None:
+            region = region.convert('RGB', matrix)
+        if kernel != None:
+            region = region.filter(kernel)
+        return region
+
+    strips = min(ENHANCE_WORKERS, height // STRIP_HEIGHT)
+    if strips <= 1:
+        return process(image) if matrix != None or kernel != None else image.copy()
+
+    # strips overlapping by a row, for the kernel
+    step = -(-height // strips)
+
+    def process_strip(y):
+        y1, y2 = max(y - 1, 0), min(y + step + 1, height)
+        strip = process(image.crop((0, y1, width, y2)))
+        return y, strip.crop((0, y - y1, width, y - y1 + min(step, height - y)))
+
+    result = Image.new('RGB', image.size)
+    for y, strip in _get_executor().map(process_strip, range(0, height, step)):
+        result.paste(strip, (0, y))
+
+    return result
+
+def enhance_reference(image, brightness=1.0, contrast=1.0, sharpness=1.0, color=1.0):
+    # the ImageEnhance chain
+    image = ImageEnhance.Brightness(image).enhance(brightness)
+    image = ImageEnhance.Contrast(image).enhance(contrast)
+    image = ImageEnhance.Sharpness(image).enhance(sharpness)
+    return ImageEnhance.Color(image).enhance(color)
+
+def compare(image, brightness=1.0, contrast=1.0, sharpness=1.0, color=1.0):
+    # (mean, max) absolute difference per channel with the ImageEnhance chain
+    difference = ImageChops.difference(enhance(image, brightness, contrast, sharpness, color), enhance_reference(image.convert('RGB'), brightness, contrast, sharpness, color))
+    return max(ImageStat.Stat(difference).mean), max(e[1] for e in difference.getextrema())
+
+def benchmark(size=(3840, 2160), parameters=((1.5, 1.0, 1.0, 1.0), (1.2, 1.3, 1.0, 1.0), (1.0, 1.0, 2.0, 1.0), (1.3, 1.2, 1.5, 1.4), (0.8, 0.7, 0.5, 0.5)), number=3):
+    # timings (in milliseconds) of the chain and of the fused enhancement, with their differences
+    gradient = Image.linear_gradient('L').resize(size)
+    image = Image.merge('RGB', (gradient, Image.radial_gradient('L').resize(size), Image.effect_noise(size, 40)))
+    results = []
+
+    for p in parameters:
+        reference = min(timeit.repeat(lambda: enhance_reference(image, *p), number=1, repeat=number))
+        fused = min(timeit.repeat(lambda: enhance(image, *p), number=1, repeat=number))
+        results.append((p, reference * 1000, fused * 1000) + compare(image, *p))
+
+    return results
+
+if __name__ == '__main__':
+    for p, reference, fused, mean, maximum in benchmark():
+        print("b=%.1f c=%.1f s=%.1f col=%.1f  chain %8.2f ms  fused %8.2f ms  error mean %.2f max %d" % (p + (reference, fused, mean, maximum)))
@@ -17,12 +17,11 @@
 
 
 import threading
+import math
 from gi.repository import GLib
 from time import sleep
-import cairo
-from PIL import Image
 
-__all__ = ['delay', 'threaded', 'cario_image_from_pil', 'pil_from_cairo_surface', 'normalize_rect']
+__all__ = ['delay', 'threaded', 'normalize_rect', 'union_rect', 'intersect_rect', 'expand_rect', 'align_rect']
 
 def delay(delay, main_thread=True):
     def wrapper(f):
@@ -54,20 +53,25 @@ def threaded():
         return run
     return wrapper
 
-def pil_from_cairo_surface(surface, format='RGB'):
-    image = Image.frombuffer(mode = 'RGBA', size = (surface.get_width(), surface.get_height()), data = surface.get_data(),)
-    b, g, r, a = image.split()
-    return Image.merge('RGBA', (r, g, b, a)) if format=='RGBA' else Image.merge('RGB', (r, g, b))
+def normalize_rect(x1, y1, x2, y2):
+    return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2), (abs(x2 - x1) > 0 and abs(y2 - y1) > 0)
 
-def cario_image_from_pil(im, alpha=1.0, format=cairo.FORMAT_ARGB32):
-    assert format in (cairo.FORMAT_RGB24, cairo.FORMAT_ARGB32), "Unsupported pixel format: %s" % format
-    if 'A' not in im.getbands():
-        im.putalpha(int(alpha * 256.))
-    arr = bytearray(im.tobytes('raw', 'BGRa'))
-    surface = cairo.ImageSurface.create_for_data(arr, format, im.width, im.height)
-    return surface
+# rects are (x1, y1, x2, y2) tuples, None being the empty rect
 
+def union_rect(a, b):
+    if a == None: return b
+    if b == None: return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
 
-def normalize_rect(x1, y1, x2, y2):
-    return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2), (abs(x2 - x1) > 0 and abs(y2 - y1) > 0)
+def intersect_rect(a, b):
+    if a == None or b == None: return None
+    x1, y1, x2, y2 = max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])
+    return (x1, y1, x2, y2) if x1 < x2 and y1 < y2 else None
+
+def expand_rect(rect, margin):
+    if rect == None: return None
+    return rect[0] - margin, rect[1] - margin, rect[2] + margin, rect[3] + margin
 
+def align_rect(rect):
+    if rect == None: return None
+    return math.floor(rect[0]), math.floor(rect[1]), math.ceil(rect[2]), math.ceil(rect[3])
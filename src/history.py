@@ -16,21 +16,92 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+# Snapshots roll back invertible operations (rotations, flips, layers changes) without keeping any pixels.
+# The others keep the smallest region they need to restore the image (the borders cut by a crop, the image
+# before a resize), zlib compressed. The most recent ones stay in memory, the older ones are spilled to a
+# temporary file, and the oldest ones are dropped beyond the history budget of the document. The spill file
+# is rewritten with the remaining pixels once most of it belongs to dropped snapshots.
+
 from gi.repository import Gio, GLib, GObject
+from PIL import Image
+import tempfile
+import zlib
+
+# compressed pixels kept in memory by the history of a document, the older ones being spilled to disk
+HISTORY_MEMORY_BUDGET = 64 * 1024 * 1024
+
+# compressed pixels kept by the history of a document (in memory and on disk), the oldest snapshots being dropped
+HISTORY_BUDGET = 512 * 1024 * 1024
+
+# zlib level of the pixels (fast, most of the gain on screenshots)
+HISTORY_COMPRESS_LEVEL = 1
+
+class PixelData:
+    # a compressed region of an image, kept by a snapshot
+
+    def __init__(self, image, box=None):
+        if box != None:
+            image = image.crop(box)
+
+        self.origin = (box[0], box[1]) if box != None else (0, 0)
+        self.mode = image.mode
+        self.dimensions = image.size
+
+        self._data = zlib.compress(image.tobytes(), HISTORY_COMPRESS_LEVEL)
+        self._file = None
+        self._offset = 0
+
+        # compressed bytes
+        self.size = len(self._data)
+
+    def spilled(self):
+        return self._file != None
+
+    def spill(self, file):
+        if self._file == None:
+            file.seek(0, 2)
+            self._offset = file.tell()
+            file.write(self._data)
+            self._file = file
+            self._data = None
+
+    def move(self, file):
+        # spilled again, to another file
+        self._data = self._read()
+        self._file = None
+        self.spill(file)
+
+    def _read(self):
+        if self._file != None:
+            self._file.seek(self._offset)
+            return self._file.read(self.size)
+        return self._data
+
+    def get_image(self):
+        return Image.frombytes(self.mode, self.dimensions, zlib.decompress(self._read()))
 
 class Snapshot(GObject.GObject):
 
     description = GObject.Property(type=str)
 
-    def __init__(self, description, rollback):
+    def __init__(self, description, rollback, data=()):
         GObject.GObject.__init__(self)
 
         self.description = description
         self.rollback = rollback
 
+        # pixels needed by the rollback
+        self.data = list(data)
+
+    def get_bytes(self):
+        return sum(d.size for d in self.data)
+
+    def get_memory_bytes(self):
+        return sum(d.size for d in self.data if not d.spilled())
+
 class History(GObject.GObject):
 
-    def __init__(self):
+    def __init__(self, memory_budget=HISTORY_MEMORY_BUDGET, budget=HISTORY_BUDGET):
         GObject.GObject.__init__(self)
 
         # snapshots
@@ -39,9 +110,68 @@ class History(GObject.GObject):
         # rollbacking
         self._rollbacking = False
 
-    def snapshot(self, description, rollback):
+        # budgets of the snapshots pixels, and the file of the spilled ones
+        self.memory_budget = memory_budget
+        self.budget = budget
+        self._spill_file = None
+
+    def snapshot(self, description, rollback, data=()):
         if not self._rollbacking:
-            self.snapshots.insert(0, Snapshot(description, rollback))
+            self.snapshots.insert(0, Snapshot(description, rollback, data))
+            self._enforce_budgets()
+
+    def _enforce_budgets(self):
+        # drop the oldest snapshots beyond the budget (keeping at least the last one)
+        total = sum(snapshot.get_bytes() for snapshot in self.snapshots)
+        while total > self.budget and len(self.snapshots) > 1:
+            total -= self.snapshots[len(self.snapshots) - 1].get_bytes()
+            self.snapshots.remove(len(self.snapshots) - 1)
+
+        # spill the oldest ones to disk
+        memory = self.get_bytes()
+        for i in reversed(range(len(self.snapshots))):
+            if memory <= self.memory_budget:
+                break
+
+            snapshot = self.snapshots[i]
+            for data in snapshot.data:
+                if not data.spilled():
+                    if self._spill_file == None:
+                        self._spill_file = tempfile.TemporaryFile()
+                    data.spill(self._spill_file)
+                    memory -= data.size
+
+        if self._spill_file != None:
+            spilled = [d for snapshot in self.snapshots for d in snapshot.data if d.spilled()]
+            live = sum(d.size for d in spilled)
+            self._spill_file.seek(0, 2)
+
+            if len(spilled) == 0:
+                # released with the last snapshot using it
+                self._spill_file.close()
+                self._spill_file = None
+            elif self._spill_file.tell() - live > live:
+                # mostly dropped snapshots: only the remaining pixels are kept, in a new file
+                spill_file = tempfile.TemporaryFile()
+                for data in spilled:
+                    data.move(spill_file)
+                self._spill_file.close()
+                self._spill_file = spill_file
+
+    def get_bytes(self):
+        # in memory
+        return sum(snapshot.get_memory_bytes() for snapshot in self.snapshots)
+
+    def get_stats(self):
+        total = sum(snapshot.get_bytes() for snapshot in self.snapshots)
+        memory = self.get_bytes()
+        return {
+            "snapshots": len(self.snapshots),
+            "memory": memory,
+            "spilled": total - memory,
+            "memory_budget": self.memory_budget,
+            "budget": self.budget,
+        }
 
     def undo(self):
         self.rollback(0)
@@ -56,4 +186,4 @@ class History(GObject.GObject):
             index -= 1
 
         self._rollbacking = False
-
+        self._enforce_budgets()
@@ -16,19 +16,82 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from PIL import Image, ImageEnhance, ImageFilter
+from PIL import Image
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 import cairo
 import gi
 import math
+import threading
 gi.require_version('PangoCairo', '1.0')
-from gi.repository import Gtk, Gdk, Gio, GObject, Pango, PangoCairo
+from gi.repository import Gtk, Gdk, Gio, GLib, GObject, Pango, PangoCairo
 from .extensions import *
+from .pixels import *
+from .tiles import TileCache
+from .enhance import enhance
+from .blur import blur, QUALITIES, QUALITY_AUTO, QUALITY_FAST, QUALITY_REFERENCE
 import copy
 
 # common default tool widths
 DEFAULT_WIDTH = 5
 
+# memory kept by each filter layer for its last results
+FILTER_RESULTS_BUDGET = 32 * 1024 * 1024
+
+# threads evaluating the filters of the displayed documents
+FILTER_WORKERS = 2
+
+_filter_executor = None
+
+def _get_filter_executor():
+    global _filter_executor
+    if _filter_executor == None:
+        _filter_executor = ThreadPoolExecutor(max_workers=FILTER_WORKERS, thread_name_prefix="filter")
+    return _filter_executor
+
+# memory shared by the image layers of all the documents, for their decoded images and scaled variants
+IMAGE_CACHE_BUDGET = 128 * 1024 * 1024
+
+# surfaces by (file signature, size), the size being None for the decoded image itself
+# (documents are also rendered by the background saves)
+_image_cache = TileCache(IMAGE_CACHE_BUDGET)
+_image_cache_lock = threading.RLock()
+
+def get_image_cache_stats():
+    with _image_cache_lock:
+        return _image_cache.get_stats()
+
+def _get_cached_image(signature, size=None):
+    with _image_cache_lock:
+        return _get_cached_image_locked(signature, size)
+
+def _get_cached_image_locked(signature, size):
+    # the decoded image of a file (with the given signature), or a variant scaled to the given size
+    path = signature[0]
+    surface = _image_cache.get((signature, size))
+
+    if surface == None and size == None:
+        # older versions of the file won't be asked for anymore
+        _image_cache.remove_if(lambda key: key[0][0] == path and key[0] != signature)
+
+        with Image.open(path) as image:
+            surface = cairo_from_pil(image)
+        _image_cache.put((signature, None), surface)
+    elif surface == None:
+        image_surface = _get_cached_image_locked(signature, None)
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, *size)
+
+        cr = cairo.Context(surface)
+        cr.scale(size[0] / image_surface.get_width(), size[1] / image_surface.get_height())
+        cr.set_source_surface(image_surface, 0, 0)
+        cr.get_source().set_filter(cairo.FILTER_GOOD)
+        cr.paint()
+        surface.flush()
+
+        _image_cache.put((signature, size), surface)
+
+    return surface
+
 class Anchor:
 
     ANCHOR_COLOR = (1, 1, 1, 1)
@@ -58,6 +121,9 @@ class Anchor:
     def valid(self):
         return self.x != None and self.y != None
 
+    def grabbed(self):
+        return self._grabbed
+
     def link(self, anchor):
         self.linked_anchors[anchor] = None
 
@@ -114,6 +180,13 @@ class Anchor:
 
             cr.restore()
 
+    def get_bounds(self, doc):
+        if self.visible and self.valid():
+            scale = 1 / (doc.scale / 100)
+            radius = (Anchor.ANCHOR_RADIUS + Anchor.ANCHOR_WIDTH) * scale + 1
+            return self.x - radius, self.y - radius, self.x + radius, self.y + radius
+        return None
+
 class Font(GObject.GObject):
 
     def __init__(self, desc):
@@ -137,6 +210,50 @@ class Selector(GObject.GObject):
         self.index = index
         return self
 
+def fit_scale(source_w, source_h, target_w, target_h, keep_aspect):
+    scale_x = 1.0
+    scale_y = 1.0
+
+    if target_w != 0 and target_h != 0:
+        if keep_aspect:
+            source_ratio = source_w / source_h
+            target_ratio = target_w / target_h
+
+            if source_ratio >= target_ratio:
+                scale_x = target_w / source_w
+                scale_y = scale_x
+            else:
+                scale_y = target_h / source_h
+                scale_x = scale_y
+        else:
+            scale_x = target_w / source_w
+            scale_y = target_h / source_h
+
+    return scale_x, scale_y
+
+def layout_context():
+    # scratch context to measure text layouts outside of the rendering
+    return cairo.Context(cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1))
+
+def layout_bounds(layout, x, y):
+    ink, logical = layout.get_pixel_extents()
+    bounds = None
+    for r in (ink, logical):
+        bounds = union_rect(bounds, (x + r.x, y + r.y, x + r.x + r.width, y + r.y + r.height))
+    return expand_rect(bounds, 2)
+
+# properties which don't change the rendering of a layer (its name, its place in the stack, its helpers)
+UNRENDERED_PROPERTIES = ("name", "dirty", "position", "active")
+
+def render_value(value):
+    if isinstance(value, Gdk.RGBA):
+        return (value.red, value.green, value.blue, value.alpha)
+    elif isinstance(value, Font):
+        return value.desc
+    elif isinstance(value, Selector):
+        return value.value()
+    return value
+
 class Layer(GObject.GObject):
 
     # keys modifiers
@@ -156,6 +273,9 @@ class Layer(GObject.GObject):
     # position of the layer in the stack
     position = GObject.Property(type=int, default=-1)
 
+    # does the layer read the pixels rendered below it?
+    READS_PREVIOUS_RENDER = False
+
     # is the layer active?
     active = GObject.Property(type=bool, default=False)
 
@@ -212,11 +332,13 @@ class Layer(GObject.GObject):
                 cr.set_dash([10, 10])
                 cr.set_line_width(1)
 
+                width, height = self.document.size
+
                 cr.move_to(mouse_x, 0)
-                cr.line_to(mouse_x, self.document.imageSurface.get_height())
+                cr.line_to(mouse_x, height)
 
                 cr.move_to(0, mouse_y)
-                cr.line_to(self.document.imageSurface.get_width(), mouse_y)
+                cr.line_to(width, mouse_y)
 
                 cr.stroke()
 
@@ -228,6 +350,64 @@ class Layer(GObject.GObject):
     def crop(self, x1, y1):
         pass
 
+    def transform(self, orientation, width, height):
+        # follows the image (of this size) oriented
+        for anchor in self.anchors:
+            if anchor.valid():
+                anchor.set(*orientation.map_point(anchor.x, anchor.y, width, height))
+
+    def get_bounds(self):
+        # area touched by the layer rendering (the whole image unless the layer knows better)
+        width, height = self.document.size
+        return 0, 0, width, height
+
+    def get_source_bounds(self):
+        # area read from the previous render
+        return None
+
+    def get_helpers_bounds(self, mouse_x, mouse_y):
+        from .window import ImagineWindow
+
+        bounds = []
+
+        if self.active:
+
+            # reticule
+            if ImagineWindow.USER_SETTINGS.get_boolean("display-reticule") and self.reticule:
+                width, height = self.document.size
+                bounds.append((mouse_x - 2, 0, mouse_x + 2, height))
+                bounds.append((0, mouse_y - 2, width, mouse_y + 2))
+
+            # anchors
+            if self.draw_anchors:
+                bounds += [anchor.get_bounds(self.document) for anchor in self.anchors]
+
+        return [b for b in bounds if b != None]
+
+    def get_render_key(self):
+        # everything the layer rendering depends on (the layers drawn differently while being drawn add their dirty flag)
+        properties = tuple(render_value(self.get_property(p.name)) for p in self.list_properties() if p.name not in UNRENDERED_PROPERTIES)
+        anchors = tuple((anchor.x, anchor.y) for anchor in self.anchors)
+        return properties, anchors
+
+    def get_state(self):
+        # layer data which is neither a property nor an anchor (persisted in projects)
+        return {}
+
+    def set_state(self, state):
+        pass
+
+    def get_cache_bytes(self):
+        # bytes of the pixels kept by the layer between two renderings
+        surface = getattr(self, "_image_surface", None)
+        image = getattr(self, "_image", None)
+        size = surface.get_stride() * surface.get_height() if surface != None else 0
+        return size + (image_bytes(image) if image != None else 0)
+
+    def release_caches(self):
+        # drops what get_cache_bytes counts and can be computed again (the document is evicted)
+        pass
+
     def valid(self):
         return True
 
@@ -253,6 +433,10 @@ class Layer(GObject.GObject):
         for anchor in self.anchors:
             anchor.mouse_move(w, cr, mouse_x, mouse_y)
 
+    def is_editing(self):
+        # is the user dragging the layer (or one of its anchors)?
+        return any(anchor.grabbed() for anchor in self.anchors)
+
     def is_first_layer(self):
         return self.position == 0
 
@@ -338,6 +522,9 @@ class RectLayer(Layer):
             self.anchor1.set(self._moving_anchor1.x + delta_x, self._moving_anchor1.y + delta_y)
             self.anchor2.set(self._moving_anchor2.x + delta_x, self._moving_anchor2.y + delta_y)
 
+    def is_editing(self):
+        return super().is_editing() or self._init or self._moving != None
+
     def valid(self):
         return self.anchor1 != None and self.anchor2 != None and self.anchor1.valid() and self.anchor2.valid()
 
@@ -359,8 +546,7 @@ class RectLayer(Layer):
             x1, y1, x2, y2, ok = normalize_rect(self.anchor1.x, self.anchor1.y, self.anchor2.x, self.anchor2.y)
 
             if ok:
-                width = self.document.imageSurface.get_width()
-                height = self.document.imageSurface.get_height()
+                width, height = self.document.size
 
                 if self.rect == RectLayer.RECT_TYPE_CLASSIC:
                     scale = 1 / (self.document.scale / 100)
@@ -388,6 +574,38 @@ class RectLayer(Layer):
          self.anchor2.x -= x1
          self.anchor2.y -= y1
 
+    def get_render_key(self):
+        key = super().get_render_key()
+
+        # the rect is only drawn once the layer is (unless persistent)
+        if self.rect != RectLayer.RECT_TYPE_NONE:
+            key += (self.persistent_rect or not self.dirty,)
+
+        # the classic rect is drawn with a zoom independent width
+        if self.rect == RectLayer.RECT_TYPE_CLASSIC:
+            key += (self.document.scale,)
+
+        return key
+
+    def get_bounds(self):
+        if self.rect != RectLayer.RECT_TYPE_NONE and (self.persistent_rect or not self.dirty) and self.valid():
+            x1, y1, x2, y2, ok = normalize_rect(self.anchor1.x, self.anchor1.y, self.anchor2.x, self.anchor2.y)
+
+            if ok:
+                if self.rect == RectLayer.RECT_TYPE_CONTRAST:
+                    return super().get_bounds()
+
+                scale = 1 / (self.document.scale / 100)
+                return expand_rect((x1, y1, x2, y2), Anchor.ANCHOR_WIDTH * scale + 1)
+
+        return None
+
+    def get_anchors_rect(self, margin=0):
+        if self.valid():
+            x1, y1, x2, y2, _ = normalize_rect(self.anchor1.x, self.anchor1.y, self.anchor2.x, self.anchor2.y)
+            return expand_rect((x1, y1, x2, y2), margin)
+        return None
+
 class PointLayer(Layer):
 
     def __init__(self, document, name, draw_anchors=True, **kwargs):
@@ -406,6 +624,9 @@ class PointLayer(Layer):
          self.anchor.x -= x1
          self.anchor.y -= y1
 
+    def get_bounds(self):
+        return None
+
     def mouse_down(self, w, cr, mouse_x, mouse_y, mouse_button):
         handled = super().mouse_down(w, cr, mouse_x, mouse_y, mouse_button)
 
@@ -458,6 +679,9 @@ class RectangleAnnotationLayer(RectLayer):
     def __init__(self, document):
         super().__init__(document, "Rectangle")
 
+    def get_bounds(self):
+        return union_rect(super().get_bounds(), self.get_anchors_rect(self.width + 1))
+
     def draw(self, w, cr, mouse_x, mouse_y):
         super().draw(w, cr, mouse_x, mouse_y)
 
@@ -491,6 +715,15 @@ class CircleAnnotationLayer(RectLayer):
             return distance <= radius
         return False
 
+    def get_bounds(self):
+        bounds = super().get_bounds()
+
+        if self.valid():
+            radius = math.sqrt((self.anchor2.x - self.anchor1.x)**2 + (self.anchor2.y - self.anchor1.y)**2) + self.width + 1
+            bounds = union_rect(bounds, (self.anchor1.x - radius, self.anchor1.y - radius, self.anchor1.x + radius, self.anchor1.y + radius))
+
+        return bounds
+
     def draw(self, w, cr, mouse_x, mouse_y):
         super().draw(w, cr, mouse_x, mouse_y)
 
@@ -522,6 +755,9 @@ class EllipseAnnotationLayer(RectLayer):
     def __init__(self, document):
         super().__init__(document, "Ellipse", rect=RectLayer.RECT_TYPE_CLASSIC, persistent_rect=True)
 
+    def get_bounds(self):
+        return union_rect(super().get_bounds(), self.get_anchors_rect(self.width + 1))
+
     def draw(self, w, cr, mouse_x, mouse_y):
         super().draw(w, cr, mouse_x, mouse_y)
 
@@ -564,6 +800,10 @@ class LineAnnotationLayer(RectLayer):
 
         self.arrow = arrow
 
+    def get_bounds(self):
+        # the arrow head is 7 times the width, its sharp miter join about twice the width
+        return union_rect(super().get_bounds(), self.get_anchors_rect(self.width * (9 if self.arrow else 1) + 1))
+
     def draw(self, w, cr, mouse_x, mouse_y):
         super().draw(w, cr, mouse_x, mouse_y)
 
@@ -601,36 +841,49 @@ class TextAnnotationLayer(PointLayer):
     def __init__(self, document):
         super().__init__(document, "Text")
 
-    def draw(self, w, cr, mouse_x, mouse_y):
-        super().draw(w, cr, mouse_x, mouse_y)
+    def _create_layout(self, cr):
+
+        # map GTK font description to Pango
+        desc = Pango.font_description_from_string(self.font.desc)
+        desc.set_size(self.size * Pango.SCALE)
+
+        # layout options
+        layout = PangoCairo.create_layout(cr)
+        layout.set_font_description(desc)
+        layout.set_alignment(Pango.Alignment.CENTER if self.centered else Pango.Alignment.LEFT)
+        layout.set_line_spacing(self.line_spacing)
+        if self.text_markup:
+            layout.set_markup(self.text, -1)
+        else:
+            layout.set_text(self.text, -1)
 
+        # font options
+        fo = cairo.FontOptions()
+        fo.set_antialias(cairo.ANTIALIAS_DEFAULT) # ANTIALIAS_SUBPIXEL
+        PangoCairo.context_set_font_options(layout.get_context(), fo)
+
+        return layout
+
+    def _get_origin(self, layout):
+        # center or not
+        width, height = layout.get_pixel_size()
+        if self.centered:
+            return self.anchor.x - width / 2, self.anchor.y - height / 2
+        return self.anchor.x, self.anchor.y
+
+    def get_bounds(self):
         if self.valid():
+            layout = self._create_layout(layout_context())
+            return layout_bounds(layout, *self._get_origin(layout))
+        return None
 
-            # map GTK font description to Pango
-            desc = Pango.font_description_from_string(self.font.desc)
-            desc.set_size(self.size * Pango.SCALE)
-
-            # layout options
-            layout = PangoCairo.create_layout(cr)
-            layout.set_font_description(desc)
-            layout.set_alignment(Pango.Alignment.CENTER if self.centered else Pango.Alignment.LEFT)
-            layout.set_line_spacing(self.line_spacing)
-            if self.text_markup:
-                layout.set_markup(self.text, -1)
-            else:
-                layout.set_text(self.text, -1)
+    def draw(self, w, cr, mouse_x, mouse_y):
+        super().draw(w, cr, mouse_x, mouse_y)
 
-            # font options
-            fo = cairo.FontOptions()
-            fo.set_antialias(cairo.ANTIALIAS_DEFAULT) # ANTIALIAS_SUBPIXEL
-            PangoCairo.context_set_font_options(layout.get_context(), fo)
+        if self.valid():
 
-            # center or not
-            width, height = layout.get_pixel_size()
-            if self.centered:
-                cr.translate(self.anchor.x - width / 2, self.anchor.y - height / 2)
-            else:
-                cr.translate(self.anchor.x, self.anchor.y)
+            layout = self._create_layout(cr)
+            cr.translate(*self._get_origin(layout))
 
             # render
             cr.set_source_rgba(self.color.red, self.color.green, self.color.blue, self.color.alpha)
@@ -665,43 +918,137 @@ class EmojiAnnotationLayer(PointLayer):
     def __init__(self, document):
         super().__init__(document, "Emoji")
 
-    def draw(self, w, cr, mouse_x, mouse_y):
-        super().draw(w, cr, mouse_x, mouse_y)
+    def _create_layout(self, cr):
 
-        if self.valid():
+        # prepare font
+        desc = Pango.font_description_from_string("Noto Sans Bold")
+        desc.set_absolute_size(Pango.SCALE * self.size)
+
+        # layout options
+        layout = PangoCairo.create_layout(cr)
+        layout.set_font_description(desc)
+        layout.set_alignment(Pango.Alignment.CENTER)
+        layout.set_text(self.emoji.value(), -1)
 
-            # prepare font
-            desc = Pango.font_description_from_string("Noto Sans Bold")
-            desc.set_absolute_size(Pango.SCALE * self.size)
+        # font options
+        fo = cairo.FontOptions()
+        fo.set_antialias(cairo.ANTIALIAS_DEFAULT)
+        PangoCairo.context_set_font_options(layout.get_context(), fo)
 
-            # layout options
-            layout = PangoCairo.create_layout(cr)
-            layout.set_font_description(desc)
-            layout.set_alignment(Pango.Alignment.CENTER)
-            layout.set_text(self.emoji.value(), -1)
+        return layout
 
-            # font options
-            fo = cairo.FontOptions()
-            fo.set_antialias(cairo.ANTIALIAS_DEFAULT)
-            PangoCairo.context_set_font_options(layout.get_context(), fo)
+    def _get_origin(self, layout):
+        # center
+        width, height = layout.get_pixel_size()
+        return self.anchor.x - width / 2, self.anchor.y - height / 2
 
-            # center
-            width, height = layout.get_pixel_size()
-            cr.translate(self.anchor.x - width / 2, self.anchor.y - height / 2)
+    def get_bounds(self):
+        if self.valid():
+            layout = self._create_layout(layout_context())
+            return layout_bounds(layout, *self._get_origin(layout))
+        return None
+
+    def draw(self, w, cr, mouse_x, mouse_y):
+        super().draw(w, cr, mouse_x, mouse_y)
+
+        if self.valid():
+
+            layout = self._create_layout(cr)
+            cr.translate(*self._get_origin(layout))
 
             # render on surface to apply alpha
             cr.set_source_rgba(1, 1, 1, 1)
             PangoCairo.show_layout(cr, layout)
 
-class LightingLayer(RectLayer):
+class FilterLayer(RectLayer):
+    # filters the pixels rendered below it, within its rect
+    #
+    # the results are cached (within a memory budget) by rect, filter parameters and content below (and
+    # the part of it actually rendered), so that an unchanged filter is only blitted while the other
+    # layers are edited
+    #
+    # on screen, filters are evaluated on a worker thread: until its result is ready, the last one
+    # is displayed (stretched to the rect) and the window is redrawn once it is. Jobs made stale by
+    # newer inputs are cancelled, or their result dropped. Headless renders (exports) wait for them.
 
-    brightness = GObject.Property(type=float, default=1.5, nick="Brightness", minimum=0.0, maximum=10.0, blurb="order=2")
-    contrast = GObject.Property(type=float, default=1.0, nick="Contrast", minimum=0.0, maximum=10.0, blurb="order=3")
-    sharpness = GObject.Property(type=float, default=1.0, nick="Sharpness", minimum=0.0, maximum=10.0, blurb="order=4")
-    color = GObject.Property(type=float, default=1.0, nick="Color", minimum=0.0, maximum=10.0, blurb="order=5")
+    READS_PREVIOUS_RENDER = True
 
-    def __init__(self, document):
-        super().__init__(document, "Lighting")
+    # properties the filter depends on
+    FILTER_PROPERTIES = ()
+
+    def __init__(self, document, name):
+        super().__init__(document, name)
+
+        self._results = TileCache(FILTER_RESULTS_BUDGET)
+
+        # pending evaluation (key, future), last displayed result (surface) and completed evaluations
+        self._job = None
+        self._last_result = None
+        self._evaluations = 0
+
+    def get_bounds(self):
+        return union_rect(super().get_bounds(), self.get_anchors_rect(1))
+
+    def get_source_bounds(self):
+        return self.get_anchors_rect(1)
+
+    def get_render_key(self):
+        # a completed evaluation replaces what was displayed in the meantime
+        return super().get_render_key() + (self._evaluations,)
+
+    def get_cache_bytes(self):
+        return self._results.size
+
+    def get_result_cache_stats(self):
+        return self._results.get_stats()
+
+    def release_caches(self):
+        self._results.clear()
+        self._last_result = None
+
+    def get_filter_parameters(self):
+        # everything the filter result depends on, besides its rect and the content below (given to apply)
+        return tuple(self.get_property(name) for name in self.FILTER_PROPERTIES)
+
+    def apply(self, image, parameters):
+        # (called from a worker thread: only the given parameters can be used)
+        return image
+
+    def _evaluate(self, image, parameters):
+        return cairo_from_pil(self.apply(image, parameters))
+
+    def _schedule(self, w, key, rect, parameters):
+        if self._job != None:
+            if self._job[0] == key:
+                return
+
+            # stale (dropped on completion if already running)
+            self._job[1].cancel()
+
+        future = _get_filter_executor().submit(self._evaluate, self.document.get_previous_render(rect), parameters)
+        self._job = (key, future)
+        future.add_done_callback(lambda f: GLib.idle_add(self._on_evaluated, w, key, f))
+
+    def _on_evaluated(self, w, key, future):
+        if self._job == None or self._job[0] != key:
+            return False
+
+        self._job = None
+
+        if future.cancelled():
+            return False
+
+        try:
+            surface = future.result()
+        except Exception as e:
+            print("Unable to apply %s: %s" % (self.name, e))
+            return False
+
+        self._results.put(key, surface)
+        self._evaluations += 1
+        w.queue_draw()
+
+        return False
 
     def draw(self, w, cr, mouse_x, mouse_y):
         super().draw(w, cr, mouse_x, mouse_y)
@@ -711,47 +1058,89 @@ class LightingLayer(RectLayer):
             x1, y1, x2, y2, ok = normalize_rect(self.anchor1.x, self.anchor1.y, self.anchor2.x, self.anchor2.y)
 
             if ok:
-                self._image = self.document.get_previous_render().crop((x1, y1, x2, y2))
+                parameters = self.get_filter_parameters()
+                # (a result evaluated on a partially rendered region is not reused once it is fully rendered)
+                coverage = self.document.get_previous_render_coverage((x1, y1, x2, y2))
+                key = ((x1, y1, x2, y2), coverage, parameters, self.document.get_previous_render_key())
+                surface = self._results.get(key)
+
+                if surface == None and w == None:
+                    surface = self._evaluate(self.document.get_previous_render((x1, y1, x2, y2)), parameters)
+                    self._results.put(key, surface)
+                elif surface == None:
+                    self._schedule(w, key, (x1, y1, x2, y2), parameters)
+
+                if surface != None:
+                    self._last_result = surface
+
+                    # draw it
+                    cr.set_source_surface(surface, x1, y1)
+                    cr.paint()
+                elif self._last_result != None:
+                    # meanwhile
+                    cr.save()
+                    cr.rectangle(x1, y1, x2 - x1, y2 - y1)
+                    cr.clip()
+                    cr.translate(x1, y1)
+                    cr.scale((x2 - x1) / self._last_result.get_width(), (y2 - y1) / self._last_result.get_height())
+                    cr.set_source_surface(self._last_result, 0, 0)
+                    cr.get_source().set_filter(cairo.FILTER_FAST)
+                    cr.paint()
+                    cr.restore()
 
-                image = ImageEnhance.Brightness(self._image).enhance(self.brightness)
-                image = ImageEnhance.Contrast(image).enhance(self.contrast)
-                image = ImageEnhance.Sharpness(image).enhance(self.sharpness)
-                image = ImageEnhance.Color(image).enhance(self.color)
+class LightingLayer(FilterLayer):
 
-                self._image_surface = cario_image_from_pil(image)
+    brightness = GObject.Property(type=float, default=1.5, nick="Brightness", minimum=0.0, maximum=10.0, blurb="order=2")
+    contrast = GObject.Property(type=float, default=1.0, nick="Contrast", minimum=0.0, maximum=10.0, blurb="order=3")
+    sharpness = GObject.Property(type=float, default=1.0, nick="Sharpness", minimum=0.0, maximum=10.0, blurb="order=4")
+    color = GObject.Property(type=float, default=1.0, nick="Color", minimum=0.0, maximum=10.0, blurb="order=5")
 
-                # draw it
-                cr.set_source_surface(self._image_surface, x1, y1)
-                cr.paint()
+    FILTER_PROPERTIES = ("brightness", "contrast", "sharpness", "color")
+
+    def __init__(self, document):
+        super().__init__(document, "Lighting")
+
+    def apply(self, image, parameters):
+        # a single fused pass (see enhance.py)
+        return enhance(image, *parameters)
+
+Selector.BLUR_QUALITY_SELECTOR = Selector(QUALITIES)
 
-class BlurLayer(RectLayer):
+class BlurLayer(FilterLayer):
 
     box = GObject.Property(type=float, default=0.0, nick="Box Blur", minimum=0.0, maximum=10.0, blurb="order=2")
     gaussian = GObject.Property(type=float, default=10.0, nick="Gaussian Blur", minimum=0.0, maximum=10.0, blurb="order=3")
+    quality = GObject.Property(type=Selector, default=Selector.BLUR_QUALITY_SELECTOR, nick="Quality", blurb="order=4")
+
+    FILTER_PROPERTIES = ("box", "gaussian")
 
     def __init__(self, document):
         super().__init__(document, "Blur")
 
-    def draw(self, w, cr, mouse_x, mouse_y):
-        super().draw(w, cr, mouse_x, mouse_y)
-
-        if self.valid():
-            x1, y1, x2, y2, ok = normalize_rect(self.anchor1.x, self.anchor1.y, self.anchor2.x, self.anchor2.y)
+        # own selector, edited in place by the layer editor
+        self.quality = Selector(QUALITIES)
 
-            if ok:
-                self._image = self.document.get_previous_render().crop((x1, y1, x2, y2))
+    def get_quality(self):
+        # auto: fast while the layer itself is dragged, reference otherwise (and on export)
+        quality = self.quality.value()
+        if quality == QUALITY_AUTO:
+            return QUALITY_FAST if self.document.interactive and self.is_editing() else QUALITY_REFERENCE
+        return quality
 
-                image = self._image.filter(ImageFilter.BoxBlur(self.box))
-                image = image.filter(ImageFilter.GaussianBlur(self.gaussian))
+    def get_render_key(self):
+        return super().get_render_key() + (self.get_quality(),)
 
-                self._image_surface = cario_image_from_pil(image)
+    def get_filter_parameters(self):
+        return super().get_filter_parameters() + (self.get_quality(),)
 
-                # draw it
-                cr.set_source_surface(self._image_surface, x1, y1)
-                cr.paint()
+    def apply(self, image, parameters):
+        # see blur.py
+        return blur(image, *parameters)
 
 class ZoomAnnotationLayer(RectLayer):
 
+    READS_PREVIOUS_RENDER = True
+
     zoom = GObject.Property(type=float, default=1.5, nick="Zoom", minimum=0.1, maximum=10.0, blurb="order=2")
     color = GObject.Property(type=Gdk.RGBA, default=Gdk.RGBA(1, 1, 1, 1), nick="Frame Color", blurb="order=4")
     frame = GObject.Property(type=bool, default=True, nick="Frame", blurb="order=3")
@@ -769,6 +1158,26 @@ class ZoomAnnotationLayer(RectLayer):
     def valid(self):
         return super().valid() and self.anchor3 != None and self.anchor3.valid()
 
+    def get_bounds(self):
+        bounds = super().get_bounds()
+
+        if self.valid():
+            x1, y1, x2, y2, _ = normalize_rect(self.anchor1.x, self.anchor1.y, self.anchor2.x, self.anchor2.y)
+            target_width = (x2 - x1) * self.zoom
+            target_height = (y2 - y1) * self.zoom
+            target_frame_x = self.anchor3.x - target_width / 2
+            target_frame_y = self.anchor3.y - target_height / 2
+
+            # source frame, target frame and its shadow (the frame effect lines stand in between)
+            margin = self.frame_width + self.zoom + 1
+            bounds = union_rect(bounds, expand_rect((x1, y1, x2, y2), margin))
+            bounds = union_rect(bounds, expand_rect((target_frame_x, target_frame_y, target_frame_x + target_width + self.shadow_extend, target_frame_y + target_height + self.shadow_extend), margin))
+
+        return bounds
+
+    def get_source_bounds(self):
+        return self.get_anchors_rect(1)
+
     def on_anchors(self, x, y):
         return super().on_anchors(x, y) or self.anchor3.within(x, y, 10)
 
@@ -789,10 +1198,6 @@ class ZoomAnnotationLayer(RectLayer):
 
             if ok:
 
-                # crop image
-                image = self.document.get_previous_render().crop((x1, y1, x2, y2))
-                self._image_surface = cario_image_from_pil(image)
-
                 # computation
                 source_x = x1
                 source_y = y1
@@ -852,11 +1257,14 @@ class ZoomAnnotationLayer(RectLayer):
                     cr.line_to(target_frame_x, target_frame_y + target_height)
                     cr.stroke()
 
-                # zoomed image
+                # zoomed image, sampled from the render below
                 cr.save()
+                cr.rectangle(target_frame_x, target_frame_y, target_width, target_height)
+                cr.clip()
                 cr.translate(target_frame_x, target_frame_y)
                 cr.scale(self.zoom, self.zoom)
-                cr.set_source_surface(self._image_surface, 0, 0)
+                cr.translate(-source_x, -source_y)
+                cr.set_source(self.document.get_previous_render_pattern((x1, y1, x2, y2)))
                 cr.paint()
                 cr.restore()
 
@@ -911,6 +1319,31 @@ class PathAnnotationLayer(Layer):
         if self._moving and self.dirty:
             self.points.append((mouse_x - self.anchor.x, mouse_y - self.anchor.y))
 
+    def get_render_key(self):
+        return super().get_render_key() + (tuple(self.points),)
+
+    def get_state(self):
+        return {"points": [list(point) for point in self.points]}
+
+    def set_state(self, state):
+        self.points = [(x, y) for x, y in state.get("points", [])]
+
+    def transform(self, orientation, width, height):
+        super().transform(orientation, width, height)
+
+        # relative to the anchor
+        self.points = [orientation.map_vector(x, y) for x, y in self.points]
+
+    def get_bounds(self):
+        if self.valid() and len(self.points) >= 1:
+            xs = [x for x, _ in self.points]
+            ys = [y for _, y in self.points]
+            bounds = (self.anchor.x + min(xs + [0]), self.anchor.y + min(ys + [0]), self.anchor.x + max(xs + [0]), self.anchor.y + max(ys + [0]))
+
+            # sharp miter joins are up to 5 times the width (default miter limit)
+            return expand_rect(bounds, self.width * 5 + 1)
+        return None
+
     def draw(self, w, cr, mouse_x, mouse_y):
         super().draw(w, cr, mouse_x, mouse_y)
 
@@ -944,10 +1377,13 @@ class ImageAnnotationLayer(RectLayer):
         super().__init__(document, "Image")
 
         self.path = path
-        self._image_surface = None
 
-        if self.path != None:
-            self._reload_image()
+        # the image is decoded on first use (and shared with the other layers showing the same file), its
+        # file being checked again only when the path changes (or on refresh)
+        self._image_size = None
+        self._image_signature = None
+        self._image_missing = False
+        self._image_version = 0
 
     def updated(self, obj, param):
         super().updated(obj, param)
@@ -955,11 +1391,73 @@ class ImageAnnotationLayer(RectLayer):
         if param.name == "path":
             self._reload_image()
 
+    def get_render_key(self):
+        # (scaled on the fly while being drawn)
+        return super().get_render_key() + (self._image_version, self.dirty)
+
+    def get_bounds(self):
+        bounds = super().get_bounds()
+
+        if self.valid():
+            image_size = self.get_image_size()
+            if image_size == None:
+                bounds = union_rect(bounds, self.get_anchors_rect(DEFAULT_WIDTH + 1))
+            else:
+                source_w, source_h = image_size
+                scale_x, scale_y = fit_scale(source_w, source_h, self.anchor2.x - self.anchor1.x, self.anchor2.y - self.anchor1.y, self.keep_aspect)
+
+                x1, y1, x2, y2, _ = normalize_rect(self.anchor1.x, self.anchor1.y, self.anchor1.x + source_w * scale_x, self.anchor1.y + source_h * scale_y)
+                bounds = union_rect(bounds, expand_rect((x1, y1, x2, y2), 1))
+
+        return bounds
+
     def _reload_image(self):
-        if self.path != None:
-            self._image_surface = cario_image_from_pil(Image.open(self.path))
-        else:
-            self._image = None
+        self._image_size = None
+        self._image_signature = None
+        self._image_missing = False
+        self._image_version += 1
+
+    def refresh(self):
+        # the file may have changed (or appeared) since it was read
+        self._reload_image()
+
+    def _get_image_signature(self):
+        # None if there is no readable image (the placeholder is drawn instead)
+        if self._image_signature == None and self.path != None and not self._image_missing:
+            try:
+                self._image_signature = file_signature(self.path)
+            except OSError:
+                self._image_missing = True
+        return self._image_signature
+
+    def get_image_size(self):
+        # read from the file header only, without decoding the image
+        if self._image_size == None and self._get_image_signature() != None:
+            try:
+                with Image.open(self.path) as image:
+                    self._image_size = image.size
+            except OSError:
+                self._image_missing = True
+                self._image_signature = None
+        return self._image_size
+
+    def get_image_surface(self, size=None):
+        # decoded image, or scaled to the given size (see _get_cached_image)
+        signature = self._get_image_signature()
+        if signature == None:
+            return None
+
+        try:
+            surface = _get_cached_image(signature, size)
+        except OSError:
+            self._image_missing = True
+            self._image_signature = None
+            self._image_size = None
+            return None
+
+        if size == None:
+            self._image_size = (surface.get_width(), surface.get_height())
+        return surface
 
     def ask_for_image_if_needed(self):
         if self.path == None:
@@ -996,45 +1494,44 @@ class ImageAnnotationLayer(RectLayer):
 
         if self.valid():
 
-            if self._image_surface == None:
+            image_size = self.get_image_size()
+            target_w = self.anchor2.x - self.anchor1.x
+            target_h = self.anchor2.y - self.anchor1.y
+            image_surface = None
+
+            if image_size != None and target_w != 0 and target_h != 0:
+                source_w, source_h = image_size
+                scale_x, scale_y = fit_scale(source_w, source_h, target_w, target_h, self.keep_aspect)
+                size = (max(int(round(abs(source_w * scale_x))), 1), max(int(round(abs(source_h * scale_y))), 1))
+
+                if self.dirty or self.document.interactive:
+                    # being resized: scaled on the fly, the sizes are only passing through
+                    image_surface = self.get_image_surface()
+                    scale = (scale_x, scale_y)
+                else:
+                    # scaled once (shared with the other layers of this size), then blitted
+                    image_surface = self.get_image_surface(size)
+                    scale = (math.copysign(source_w * abs(scale_x) / size[0], scale_x), math.copysign(source_h * abs(scale_y) / size[1], scale_y))
+
+            if image_surface != None:
+                cr.save()
+                cr.translate(self.anchor1.x, self.anchor1.y)
+                cr.scale(*scale)
+                cr.set_source_surface(image_surface, 0, 0)
+                cr.paint_with_alpha(self.alpha)
+                cr.restore()
+            else:
+                # no (readable) image yet
                 cr.set_source_rgba(1, 1, 1, 0.75)
                 cr.set_line_width(DEFAULT_WIDTH)
                 cr.set_dash([10, 10])
-                cr.rectangle(self.anchor1.x, self.anchor1.y, self.anchor2.x - self.anchor1.x, self.anchor2.y - self.anchor1.y)
+                cr.rectangle(self.anchor1.x, self.anchor1.y, target_w, target_h)
                 cr.stroke()
-            else:
-
-                source_w = self._image_surface.get_width()
-                source_h = self._image_surface.get_height()
-                target_w = self.anchor2.x - self.anchor1.x
-                target_h = self.anchor2.y - self.anchor1.y
-                scale_x = 1.0
-                scale_y = 1.0
-
-                if target_w != 0 and target_h != 0:
-                    if self.keep_aspect:
-                        source_ratio = source_w / source_h
-                        target_ratio = target_w / target_h
-
-                        if source_ratio >= target_ratio:
-                            scale_x = target_w / source_w
-                            scale_y = scale_x
-                        else:
-                            scale_y = target_h / source_h
-                            scale_x = scale_y
-                    else:
-                        scale_x = target_w / source_w
-                        scale_y = target_h / source_h
-
-                    cr.save()
-                    cr.translate(self.anchor1.x, self.anchor1.y)
-                    cr.scale(scale_x, scale_y)
-                    cr.set_source_surface(self._image_surface, 0, 0)
-                    cr.paint_with_alpha(self.alpha)
-                    cr.restore()
 
 class CloneAnnotationLayer(RectLayer):
 
+    READS_PREVIOUS_RENDER = True
+
     live = GObject.Property(type=bool, default=False, nick="Live", blurb="order=2")
     keep_aspect = GObject.Property(type=bool, default=True, nick="Keep Aspect", blurb="order=3")
     frame = GObject.Property(type=bool, default=True, nick="Frame", blurb="order=4")
@@ -1058,8 +1555,94 @@ class CloneAnnotationLayer(RectLayer):
 
         self._image_surface = None
 
+        # static snapshot restored from a project, captured again on first use
+        self._restore_snapshot = False
+
     def clear(self):
         self._image_surface = None
+        self._restore_snapshot = False
+
+    def get_state(self):
+        if not self.live and (self._image_surface != None or self._restore_snapshot):
+            return {"snapshot": [self._snap_x1, self._snap_y1, self._snap_x2, self._snap_y2]}
+        return {}
+
+    def set_state(self, state):
+        if "snapshot" in state:
+            self._snap_x1, self._snap_y1, self._snap_x2, self._snap_y2 = state["snapshot"]
+            self._image_surface = None
+            self._restore_snapshot = True
+
+    def transform(self, orientation, width, height):
+        super().transform(orientation, width, height)
+
+        self._snap_x1, self._snap_y1, self._snap_x2, self._snap_y2 = orientation.map_rect((self._snap_x1, self._snap_y1, self._snap_x2, self._snap_y2), width, height)
+
+        # the static snapshot is captured again, oriented
+        if not self.live and self._image_surface != None:
+            self._image_surface = None
+            self._restore_snapshot = True
+
+    def _snapshot(self):
+        # copy of the render below, within the snap rect (its pixels are owned: the composites are reused)
+        x1, y1, x2, y2 = self._snap_x1, self._snap_y1, self._snap_x2, self._snap_y2
+        surface = cairo.ImageSurface(cairo.FORMAT_RGB24, max(int(round(x2)) - int(round(x1)), 1), max(int(round(y2)) - int(round(y1)), 1))
+
+        cr = cairo.Context(surface)
+        cr.translate(-x1, -y1)
+        cr.set_source(self.document.get_previous_render_pattern((x1, y1, x2, y2)))
+        cr.paint()
+        surface.flush()
+
+        return surface
+
+    def get_snapshot_surface(self):
+        # pixels captured by a static clone, if any
+        return self._image_surface if not self.live else None
+
+    def set_snapshot_surface(self, surface):
+        # (shared: captured surfaces are never drawn into)
+        self._image_surface = surface
+        self._restore_snapshot = False
+
+    def _get_static_surface(self):
+        if self._image_surface == None and self._restore_snapshot:
+            self._image_surface = self._snapshot()
+            self._restore_snapshot = False
+        return self._image_surface
+
+    def get_render_key(self):
+        return super().get_render_key() + ((self._snap_x1, self._snap_y1, self._snap_x2, self._snap_y2), self._image_surface)
+
+    def get_source_bounds(self):
+        if self.live or self._restore_snapshot:
+            return expand_rect((self._snap_x1, self._snap_y1, self._snap_x2, self._snap_y2), 1)
+        elif self._image_surface == None:
+            return self.get_anchors_rect(1)
+        return None
+
+    def get_bounds(self):
+        bounds = super().get_bounds()
+
+        if self.valid():
+            x1, y1, x2, y2, ok = normalize_rect(self.anchor1.x, self.anchor1.y, self.anchor2.x, self.anchor2.y)
+
+            if ok:
+                if self.live or self._restore_snapshot:
+                    source_width, source_height = self._snap_x2 - self._snap_x1, self._snap_y2 - self._snap_y1
+                elif self._image_surface != None:
+                    source_width, source_height = self._image_surface.get_width(), self._image_surface.get_height()
+                else:
+                    source_width, source_height = x2 - x1, y2 - y1
+
+                if source_width > 0 and source_height > 0:
+                    scale_x, scale_y = fit_scale(source_width, source_height, self.anchor2.x - self.anchor1.x, self.anchor2.y - self.anchor1.y, self.keep_aspect)
+
+                    # image and frame, with the shadow on the bottom right
+                    fx1, fy1, fx2, fy2, _ = normalize_rect(x1, y1, x1 + source_width * scale_x, y1 + source_height * scale_y)
+                    bounds = union_rect(bounds, expand_rect((fx1, fy1, fx2 + self.shadow_extend, fy2 + self.shadow_extend), self.frame_width + 1))
+
+        return bounds
 
     def clone(self):
 
@@ -1071,8 +1654,9 @@ class CloneAnnotationLayer(RectLayer):
             self._snap_x2 = x2
             self._snap_y2 = y2
 
-            image = self.document.get_previous_render().crop((x1, y1, x2, y2))
-            self._image_surface = cario_image_from_pil(image)
+            # only captured again when the snap rect changes
+            self._image_surface = self._snapshot()
+            self._restore_snapshot = False
 
     def mouse_down(self, w, cr, mouse_x, mouse_y, mouse_button):
         if not self.between_anchors(mouse_x, mouse_y) and Layer.KEY_CONTROL:
@@ -1101,48 +1685,31 @@ class CloneAnnotationLayer(RectLayer):
 
             if ok:
 
-                # copy
+                # source (the live ones are sampled from the render below, without any copy)
                 image_surface = None
                 if self.live:
                     # dynamic clone
-                    image = self.document.get_previous_render().crop((self._snap_x1, self._snap_y1, self._snap_x2, self._snap_y2))
-                    image_surface = cario_image_from_pil(image)
-                elif self._image_surface != None:
+                    sx1, sy1, sx2, sy2 = self._snap_x1, self._snap_y1, self._snap_x2, self._snap_y2
+                elif self._image_surface != None or self._restore_snapshot:
                     # static clone
-                    image_surface = self._image_surface
+                    image_surface = self._get_static_surface()
+                    sx1, sy1, sx2, sy2 = 0, 0, image_surface.get_width(), image_surface.get_height()
                 else:
                     # not live, no static image: it means we are building up the frame
-                    image = self.document.get_previous_render().crop((x1, y1, x2, y2))
-                    image_surface = cario_image_from_pil(image)
+                    sx1, sy1, sx2, sy2 = x1, y1, x2, y2
 
-                if image_surface != None:
+                if sx2 - sx1 > 0 and sy2 - sy1 > 0:
 
                     # computation
-                    source_width = image_surface.get_width()
-                    source_height = image_surface.get_height()
+                    source_width = sx2 - sx1
+                    source_height = sy2 - sy1
                     target_frame_x = x1
                     target_frame_y = y1
                     target_width = self.anchor2.x - self.anchor1.x
                     target_height = self.anchor2.y - self.anchor1.y
 
                     # scale
-                    scale_x = 1.0
-                    scale_y = 1.0
-
-                    if target_width != 0 and target_height != 0:
-                        if self.keep_aspect:
-                            source_ratio = source_width / source_height
-                            target_ratio = target_width / target_height
-
-                            if source_ratio >= target_ratio:
-                                scale_x = target_width / source_width
-                                scale_y = scale_x
-                            else:
-                                scale_y = target_height / source_height
-                                scale_x = scale_y
-                        else:
-                            scale_x = target_width / source_width
-                            scale_y = target_height / source_height
+                    scale_x, scale_y = fit_scale(source_width, source_height, target_width, target_height, self.keep_aspect)
 
                     frame_width = source_width * scale_x
                     frame_height = source_height * scale_y
@@ -1151,7 +1718,13 @@ class CloneAnnotationLayer(RectLayer):
                     cr.save()
                     cr.translate(x1, y1)
                     cr.scale(scale_x, scale_y)
-                    cr.set_source_surface(image_surface, 0, 0)
+                    cr.translate(-sx1, -sy1)
+                    cr.rectangle(sx1, sy1, source_width, source_height)
+                    cr.clip()
+                    if image_surface != None:
+                        cr.set_source_surface(image_surface, 0, 0)
+                    else:
+                        cr.set_source(self.document.get_previous_render_pattern((sx1, sy1, sx2, sy2)))
                     cr.paint()
                     cr.restore()
 
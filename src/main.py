@@ -49,5 +49,11 @@ class Application(Gtk.Application):
 
 
 def main(version):
+
+    # command line batch annotation, without any window
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        from .batch import run
+        return run(sys.argv[2:])
+
     app = Application()
     return app.run(sys.argv)
@@ -0,0 +1,79 @@
+# memory.py
+#
+# Copyright 2021 Brice MARTIN
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Memory budget of the opened documents.
+#
+# Each document reports the bytes it holds (pixels, composites and tiles caches, history, layers caches).
+# The history is left out of the budget: it is bounded per document by its own budgets (see history.py),
+# and evicting a document would not release it. When the rest exceeds the budget, the decoded pixels of
+# the least recently selected documents are evicted, to be decoded again when they are displayed (from
+# their file, or from a compressed spill file if the image was modified since).
+
+class MemoryManager:
+
+    def __init__(self, budget):
+        self.budget = budget
+
+        # documents, least recently selected first
+        self._recent = []
+
+        # statistics
+        self.evictions = 0
+        self.evicted_bytes = 0
+
+    def touch(self, document):
+        self.forget(document)
+        self._recent.append(document)
+
+    def forget(self, document):
+        if document in self._recent:
+            self._recent.remove(document)
+
+    def get_bytes(self, documents):
+        # bytes the evictions can release
+        return sum(document.get_evictable_bytes() for document in documents)
+
+    def enforce(self, documents, keep=None):
+        # evicts documents (never the kept one) until within the budget, returning the number of bytes freed
+        total = self.get_bytes(documents)
+        freed = 0
+
+        # never selected documents first, then the least recently selected ones
+        candidates = [d for d in documents if d not in self._recent] + [d for d in self._recent if d in documents]
+
+        for document in candidates:
+            if total - freed <= self.budget:
+                break
+            if document is keep or document.loading or document.evicted():
+                continue
+
+            evicted = document.evict()
+            if evicted > 0:
+                freed += evicted
+                self.evictions += 1
+                self.evicted_bytes += evicted
+
+        return freed
+
+    def get_stats(self, documents):
+        return {
+            "bytes": self.get_bytes(documents),
+            "history": sum(document.history.get_bytes() for document in documents),
+            "budget": self.budget,
+            "evictions": self.evictions,
+            "evicted_bytes": self.evicted_bytes,
+        }
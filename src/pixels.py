@@ -0,0 +1,404 @@
+# pixels.py
+#
+# Copyright 2021 Brice MARTIN
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Pixel format bridge between PIL images and cairo surfaces.
+#
+# Cairo pixels are native endian 32 bits words (BGRA bytes on little endian machines), premultiplied
+# by alpha for ARGB32 surfaces, with rows padded to the surface stride. The conversions go through
+# the raw codecs of PIL, which (un)pack, swizzle and (un)premultiply a whole buffer in a single pass,
+# reading and writing the cairo buffer in place through memoryviews. Input images and surfaces are
+# never modified.
+
+import cairo
+import math
+import os
+import tempfile
+import threading
+import timeit
+from PIL import Image
+from gi.repository import GdkPixbuf, GLib
+
+__all__ = ['pil_from_cairo', 'cairo_from_pil', 'pixbuf_from_pil', 'thumbnail_from_pil', 'open_image', 'file_signature', 'image_bytes', 'Orientation', 'PixelStore']
+
+# zlib level of the evicted pixels spilled to disk (fast, most of the gain on screenshots)
+SPILL_COMPRESS_LEVEL = 1
+
+# raw decoders of the cairo surface formats: bytes per pixel and rawmode of each directly decoded PIL mode
+DECODERS = {
+    cairo.FORMAT_ARGB32: (4, {'RGB': 'BGRX', 'RGBA': 'BGRa'}),
+    cairo.FORMAT_RGB24: (4, {'RGB': 'BGRX'}),
+    cairo.FORMAT_A8: (1, {'L': 'L'}),
+}
+
+def pil_from_cairo(surface, mode='RGB', rect=None):
+    format = surface.get_format()
+    assert format in DECODERS, "Unsupported surface format: %s" % format
+    bpp, rawmodes = DECODERS[format]
+    width, height = surface.get_width(), surface.get_height()
+
+    # requested region, cropped like PIL would do (outside pixels are left black)
+    x1, y1, x2, y2 = [int(round(v)) for v in rect] if rect != None else (0, 0, width, height)
+    cx1, cy1, cx2, cy2 = max(x1, 0), max(y1, 0), min(x2, width), min(y2, height)
+
+    if cx1 >= cx2 or cy1 >= cy2:
+        return Image.new(mode, (max(x2 - x1, 0), max(y2 - y1, 0)))
+
+    # modes without a raw decoder go through the closest decoded one
+    decoded = mode if mode in rawmodes else ('RGBA' if 'A' in mode and 'RGBA' in rawmodes else next(iter(rawmodes)))
+
+    # only decode the rows and columns of the region
+    surface.flush()
+    stride = surface.get_stride()
+    data = memoryview(surface.get_data())[cy1 * stride + cx1 * bpp:]
+    image = Image.frombytes(decoded, (cx2 - cx1, cy2 - cy1), data, 'raw', rawmodes[decoded], stride)
+
+    if decoded != mode:
+        image = image.convert(mode)
+
+    if (cx1, cy1, cx2, cy2) != (x1, y1, x2, y2):
+        region = Image.new(mode, (x2 - x1, y2 - y1))
+        region.paste(image, (cx1 - x1, cy1 - y1))
+        image = region
+
+    return image
+
+def _normalize(image, alpha=1.0):
+    # RGBA (translucent) or RGB (opaque) version of any PIL image, a new one if it has to change
+    mode = image.mode
+
+    if mode in ('I;16', 'I;16L', 'I;16B', 'I;16N'):
+        image = image.convert('I').point(lambda v: v * (1 / 256)).convert('RGB')
+    elif mode in ('I', 'F'):
+        image = image.convert('L').convert('RGB')
+    elif mode == 'P':
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    elif mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() or mode == 'RGBa' else 'RGB')
+
+    # uniform alpha of opaque images
+    if alpha < 1.0 and image.mode == 'RGB':
+        image = image.convert('RGBA')
+        image.putalpha(int(alpha * 255))
+
+    return image
+
+def cairo_from_pil(image, alpha=1.0):
+    image = _normalize(image, alpha)
+
+    # opaque images don't need any alpha channel
+    if image.mode == 'RGBA':
+        format, rawmode = cairo.FORMAT_ARGB32, 'BGRa'
+    else:
+        format, rawmode = cairo.FORMAT_RGB24, 'BGRX'
+
+    surface = cairo.ImageSurface(format, image.width, image.height)
+
+    if image.width > 0 and image.height > 0:
+        # packed straight to the surface layout (stride included), then copied once into its buffer
+        surface.flush()
+        memoryview(surface.get_data())[:] = image.tobytes('raw', rawmode, surface.get_stride())
+        surface.mark_dirty()
+
+    return surface
+
+def pixbuf_from_pil(image):
+    image = _normalize(image)
+    has_alpha = image.mode == 'RGBA'
+    rowstride = image.width * (4 if has_alpha else 3)
+    return GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(image.tobytes()), GdkPixbuf.Colorspace.RGB, has_alpha, 8, image.width, image.height, rowstride)
+
+def thumbnail_from_pil(image, size):
+    # downscaled (keeping the aspect ratio, within size x size) straight to a pixbuf, without modifying the image
+    scale = min(size / image.width, size / image.height, 1.0)
+    width, height = max(int(round(image.width * scale)), 1), max(int(round(image.height * scale)), 1)
+    return pixbuf_from_pil(image.resize((width, height), Image.ANTIALIAS, reducing_gap=3.0))
+
+def open_image(path, preview_size=None):
+    # (image, size, loader): JPEGs may be opened as a reduced preview only (decoded in draft mode, at
+    # 1/2, 1/4 or 1/8 of their size), their full resolution image being decoded later by the loader
+    image = Image.open(path)
+    size = image.size
+
+    if preview_size != None and image.format == 'JPEG' and max(size) > preview_size * 2:
+        scale = preview_size / max(size)
+        image.draft('RGB', (max(int(size[0] * scale), 1), max(int(size[1] * scale), 1)))
+
+        if image.size != size:
+            image.load()
+            return image, size, lambda: Image.open(path)
+
+    return image, size, None
+
+def image_bytes(image):
+    return image.width * image.height * len(image.getbands())
+
+def file_signature(path):
+    # identifies the content of a file, to know if it can be decoded again
+    stat = os.stat(path)
+    return path, stat.st_mtime_ns, stat.st_size
+
+class Orientation:
+    # one of the 8 lossless orientations of an image (quarter turns, optionally mirrored), as the integer
+    # matrix mapping the stored pixels to the displayed ones (translated back to the origin)
+
+    # PIL transpositions (and their jpegtran equivalents) of each orientation matrix
+    TRANSPOSITIONS = {
+        (-1, 0, 0, 1): ("FLIP_LEFT_RIGHT", ["-flip", "horizontal"]),
+        (1, 0, 0, -1): ("FLIP_TOP_BOTTOM", ["-flip", "vertical"]),
+        (0, 1, -1, 0): ("ROTATE_90", ["-rotate", "270"]),
+        (-1, 0, 0, -1): ("ROTATE_180", ["-rotate", "180"]),
+        (0, -1, 1, 0): ("ROTATE_270", ["-rotate", "90"]),
+        (0, 1, 1, 0): ("TRANSPOSE", ["-transpose"]),
+        (0, -1, -1, 0): ("TRANSVERSE", ["-transverse"]),
+    }
+
+    def __init__(self, xx=1, xy=0, yx=0, yy=1):
+        self.xx, self.xy, self.yx, self.yy = xx, xy, yx, yy
+
+    @staticmethod
+    def from_name(name):
+        # from the name of its PIL transposition (None for the identity)
+        for matrix, (transposition, _) in Orientation.TRANSPOSITIONS.items():
+            if transposition == name:
+                return Orientation(*matrix)
+        if name != None:
+            raise ValueError("Unknown orientation: %s" % name)
+        return Orientation()
+
+    def _matrix(self):
+        return self.xx, self.xy, self.yx, self.yy
+
+    def __eq__(self, other):
+        return isinstance(other, Orientation) and self._matrix() == other._matrix()
+
+    def __hash__(self):
+        return hash(self._matrix())
+
+    def is_identity(self):
+        return self._matrix() == (1, 0, 0, 1)
+
+    def get_name(self):
+        return Orientation.TRANSPOSITIONS[self._matrix()][0] if not self.is_identity() else None
+
+    def get_jpegtran_args(self):
+        return Orientation.TRANSPOSITIONS[self._matrix()][1] if not self.is_identity() else []
+
+    def then(self, other):
+        # this orientation, followed by the other one
+        return Orientation(
+            other.xx * self.xx + other.xy * self.yx, other.xx * self.xy + other.xy * self.yy,
+            other.yx * self.xx + other.yy * self.yx, other.yx * self.xy + other.yy * self.yy)
+
+    def inverse(self):
+        return Orientation(self.xx, self.yx, self.xy, self.yy)
+
+    def get_size(self, width, height):
+        return abs(self.xx) * width + abs(self.xy) * height, abs(self.yx) * width + abs(self.yy) * height
+
+    def _offset(self, width, height):
+        return max(-self.xx, 0) * width + max(-self.xy, 0) * height, max(-self.yx, 0) * width + max(-self.yy, 0) * height
+
+    def map_point(self, x, y, width, height):
+        # point of an image of this size, once oriented
+        ox, oy = self._offset(width, height)
+        return self.xx * x + self.xy * y + ox, self.yx * x + self.yy * y + oy
+
+    def map_vector(self, x, y):
+        return self.xx * x + self.xy * y, self.yx * x + self.yy * y
+
+    def map_rect(self, rect, width, height):
+        if rect == None: return None
+        x1, y1 = self.map_point(rect[0], rect[1], width, height)
+        x2, y2 = self.map_point(rect[2], rect[3], width, height)
+        return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+    def unmap_rect(self, rect, width, height):
+        # rect of the oriented image, in the image of this size
+        return self.inverse().map_rect(rect, *self.get_size(width, height))
+
+    def get_matrix(self, width, height):
+        # cairo matrix drawing an image of this size oriented
+        ox, oy = self._offset(width, height)
+        return cairo.Matrix(self.xx, self.yx, self.xy, self.yy, ox, oy)
+
+    def transpose(self, image):
+        # losslessly oriented copy of a PIL image (the image itself for the identity)
+        if self.is_identity():
+            return image
+        return image.transpose(getattr(Image, self.get_name()))
+
+    def transpose_pixbuf(self, pixbuf):
+        # a mirror (maybe), then counterclockwise quarter turns
+        for flip in (False, True):
+            for turns in range(4):
+                orientation = Orientation(-1, 0, 0, 1) if flip else Orientation()
+                for _ in range(turns):
+                    orientation = orientation.then(Orientation(0, 1, -1, 0))
+                if orientation == self:
+                    if flip:
+                        pixbuf = pixbuf.flip(True)
+                    return pixbuf.rotate_simple(GdkPixbuf.PixbufRotation(turns * 90)) if turns > 0 else pixbuf
+
+class PixelStore:
+    # the canonical pixels of a document, kept a single time: in the cairo layout (the rendering
+    # reads them as they are), or as a PIL image for the very large ones (converted by regions)
+    #
+    # the pixels may be evicted, then decoded again on next use: from their file (source, as returned
+    # by file_signature) while it is left untouched, else from a compressed spill file
+
+    def __init__(self, image, surface=True, size=None, loader=None, source=None):
+        self._as_surface = surface
+        self._loader = loader
+        self._lock = threading.Lock()
+        self.source = source
+        self.surface = None
+        self._image = None
+
+        # reduced preview, until the full resolution image is needed
+        self.preview = None
+        self.preview_level = 0
+        self._preview_surface = None
+
+        if loader == None:
+            self._store(image)
+        else:
+            self.preview = _normalize(image)
+            self.size = size
+            self.width, self.height = size
+            self.mode = self.preview.mode
+            self.preview_level = max(int(round(math.log2(self.width / self.preview.width))), 0)
+
+    def _store(self, image):
+        image = _normalize(image)
+
+        self.size = image.size
+        self.width, self.height = image.size
+        self.mode = image.mode
+
+        self.surface = cairo_from_pil(image) if self._as_surface else None
+        self._image = image if not self._as_surface else None
+
+        self.preview = None
+        self.preview_level = 0
+        self._preview_surface = None
+
+    def loaded(self):
+        return self._loader == None
+
+    def evicted(self):
+        return self._loader != None and self.preview == None
+
+    def load(self):
+        # full resolution decoding, on first use (from any thread)
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        if self._loader != None:
+            image = self._loader()
+            image.load()
+            self._store(image)
+            self._loader = None
+
+    def detach(self):
+        # the source file is about to be overwritten: decoded while it can be, then never read again
+        with self._lock:
+            self._load()
+            self.source = None
+
+    def evict(self):
+        # releases the full resolution pixels, returning the number of bytes freed
+        with self._lock:
+            if self._loader != None:
+                return 0
+
+            freed = self.get_bytes()
+
+            if self.source != None and file_signature(self.source[0]) == self.source:
+                path = self.source[0]
+                self._loader = lambda: Image.open(path)
+            else:
+                image = pil_from_cairo(self.surface, self.mode) if self.surface != None else self._image
+                spill = tempfile.TemporaryFile()
+                image.save(spill, format="PNG", compress_level=SPILL_COMPRESS_LEVEL)
+
+                def load_spill():
+                    spill.seek(0)
+                    return Image.open(spill)
+
+                self._loader = load_spill
+
+            self.surface = None
+            self._image = None
+
+            return freed
+
+    def get_bytes(self):
+        if not self.loaded():
+            return self.preview.width * self.preview.height * 4 if self.preview != None else 0
+        if self.surface != None:
+            return self.surface.get_stride() * self.height
+        return self.width * self.height * 4
+
+    def get_preview_surface(self, level):
+        # the preview, if it is detailed enough to be displayed at this pyramid level
+        if self.loaded() or self.preview == None or level < self.preview_level:
+            return None
+
+        if self._preview_surface == None:
+            self._preview_surface = cairo_from_pil(self.preview)
+        return self._preview_surface
+
+    def get_surface(self):
+        # shared, without any copy (for reading: the store is never drawn into)
+        self.load()
+        return self.surface
+
+    def get_image(self, rect=None, mode=None):
+        # PIL images are read only views of the store (or decoded copies of its regions)
+        self.load()
+        mode = self.mode if mode == None else mode
+
+        if self.surface != None:
+            return pil_from_cairo(self.surface, mode, rect)
+
+        image = self._image if rect == None else self._image.crop(tuple(int(round(v)) for v in rect))
+        return image if image.mode == mode else image.convert(mode)
+
+    def get_pixbuf(self, rect=None):
+        return pixbuf_from_pil(self.get_image(rect))
+
+def benchmark(sizes=((256, 256), (1920, 1080), (6000, 4000)), modes=('RGB', 'RGBA', 'L', 'P', 'LA', 'I;16'), number=5):
+    # conversion timings (in milliseconds) for each direction, mode and size
+    results = []
+
+    for width, height in sizes:
+        for mode in modes:
+            image = Image.new('RGBA', (width, height), (200, 100, 50, 128)).convert(mode)
+            t = min(timeit.repeat(lambda: cairo_from_pil(image), number=1, repeat=number))
+            results.append(("pil -> cairo", mode, width, height, t * 1000))
+
+        for format, mode in ((cairo.FORMAT_RGB24, 'RGB'), (cairo.FORMAT_ARGB32, 'RGB'), (cairo.FORMAT_ARGB32, 'RGBA'), (cairo.FORMAT_ARGB32, 'L')):
+            surface = cairo.ImageSurface(format, width, height)
+            t = min(timeit.repeat(lambda: pil_from_cairo(surface, mode), number=1, repeat=number))
+            results.append(("cairo -> pil", "%s %s" % ("ARGB32" if format == cairo.FORMAT_ARGB32 else "RGB24", mode), width, height, t * 1000))
+
+    return results
+
+if __name__ == '__main__':
+    for direction, mode, width, height, ms in benchmark():
+        print("%-13s %-12s %5dx%-5d %9.2f ms" % (direction, mode, width, height, ms))
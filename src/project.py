@@ -0,0 +1,259 @@
+# project.py
+#
+# Copyright 2021 Brice MARTIN
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Projects keep a document and its (non destructive) layers stack.
+#
+# A project is a zip archive holding a "project.json" manifest:
+#
+#   {
+#       "version": 1,
+#       "image": {"path": "/home/me/shot.png", "relative": "shot.png", "orientation": "ROTATE_90"},   (or {"path": ..., "embedded": "image.png"})
+#       "scale": 100,
+#       "layers": [
+#           {"type": "LineAnnotationLayer", "properties": {"color": "rgb(255,0,0)", "arrow": true, ...}, "anchors": [[10, 10], [200, 120]], "state": {}},
+#           ...
+#       ]
+#   }
+#
+# Layers are listed bottom to top. The source image is referenced, unless asked otherwise or modified
+# (crop, resize...) or overwritten by an export, in which case its bytes are embedded in the archive.
+# Rotations and flips are only kept as the orientation of the image (the name of its PIL transposition,
+# absent if none).
+
+from PIL import Image
+from gi.repository import Gdk
+from io import BytesIO
+import json
+import os
+import time
+import zipfile
+from .document import Document
+from .pixels import Orientation, file_signature
+from . import layers
+from .layers import Layer, Font, Selector
+
+PROJECT_EXTENSION = ".imagine"
+PROJECT_VERSION = 1
+PROJECT_MANIFEST = "project.json"
+
+# properties which are only runtime state
+TRANSIENT_PROPERTIES = ("dirty", "position", "active")
+
+def get_layer_class(name):
+    cls = getattr(layers, name, None)
+    if not isinstance(cls, type) or not issubclass(cls, Layer) or cls in (Layer, layers.RectLayer, layers.PointLayer, layers.FilterLayer):
+        raise ValueError("Unknown layer type: %s" % name)
+    return cls
+
+def serialize_value(value):
+    if isinstance(value, Gdk.RGBA):
+        return value.to_string()
+    elif isinstance(value, Font):
+        return value.desc
+    elif isinstance(value, Selector):
+        return value.value()
+    return value
+
+def property_value(layer, name, value):
+    if layer.find_property(name) == None:
+        raise ValueError("Unknown property for %s: %s" % (layer.name, name))
+
+    current = layer.get_property(name)
+
+    if isinstance(current, Gdk.RGBA):
+        rgba = Gdk.RGBA()
+        if not rgba.parse(value):
+            raise ValueError("Invalid color for %s: %s" % (name, value))
+        return rgba
+    elif isinstance(current, Font):
+        return Font(value)
+    elif isinstance(current, Selector):
+        return Selector(current.options, current.options.index(value))
+
+    return value
+
+def layer_to_spec(layer):
+    return {
+        "type": type(layer).__name__,
+        "properties": {p.name: serialize_value(layer.get_property(p.name)) for p in layer.list_properties() if p.name not in TRANSIENT_PROPERTIES},
+        "anchors": [[anchor.x, anchor.y] for anchor in layer.anchors],
+        "state": layer.get_state(),
+    }
+
+def layer_from_spec(document, spec):
+    layer = get_layer_class(spec["type"])(document)
+
+    for name, value in spec.get("properties", {}).items():
+        layer.set_property(name, property_value(layer, name, value))
+
+    anchors = spec.get("anchors", [])
+    if len(anchors) > len(layer.anchors):
+        raise ValueError("Too many anchors for %s: %d (expected %d)" % (layer.name, len(anchors), len(layer.anchors)))
+
+    for anchor, (x, y) in zip(layer.anchors, anchors):
+        anchor.set(x, y)
+
+    layer.set_state(spec.get("state", {}))
+
+    # finished, as if drawn interactively
+    layer.dirty = False
+
+    return layer
+
+def get_source_path(document):
+    # the file the image was decoded from, if it still holds it (not overwritten by an export since)
+    source = document.pixels.source
+    if document.image_modified or source == None or not os.path.exists(source[0]) or file_signature(source[0]) != source:
+        return None
+    return source[0]
+
+def save_project(document, path, embed=False):
+    project_dir = os.path.dirname(os.path.abspath(path))
+    source_path = get_source_path(document)
+    image = {"path": os.path.abspath(source_path if source_path != None else document.path)}
+
+    if not document.orientation.is_identity():
+        image["orientation"] = document.orientation.get_name()
+
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+
+        if embed or source_path == None:
+            if source_path != None:
+                # original bytes, as is
+                image["embedded"] = "image" + os.path.splitext(source_path)[1].lower()
+                archive.write(source_path, image["embedded"], compress_type=zipfile.ZIP_STORED)
+            else:
+                buffer = BytesIO()
+                document.pixels.get_image().save(buffer, format="PNG")
+                image["embedded"] = "image.png"
+                archive.writestr(image["embedded"], buffer.getvalue(), compress_type=zipfile.ZIP_STORED)
+            image["modified"] = document.image_modified
+        else:
+            image["relative"] = os.path.relpath(image["path"], project_dir)
+
+        manifest = {
+            "version": PROJECT_VERSION,
+            "image": image,
+            "scale": document.scale,
+            "layers": [layer_to_spec(layer) for layer in reversed(list(document.layers))],
+        }
+
+        archive.writestr(PROJECT_MANIFEST, json.dumps(manifest, separators=(",", ":")))
+
+    document.project_path = path
+
+def load_project(path, deferred=False):
+    # deferred: the image is left to be decoded (by Document.decode, away from the main thread)
+    project_dir = os.path.dirname(os.path.abspath(path))
+
+    with zipfile.ZipFile(path) as archive:
+        manifest = json.loads(archive.read(PROJECT_MANIFEST))
+
+        if manifest.get("version", 0) > PROJECT_VERSION:
+            raise ValueError("Unsupported project version: %s" % manifest["version"])
+
+        image = manifest["image"]
+        data = None
+
+        if "embedded" in image:
+            data = archive.read(image["embedded"])
+            image_path = image["path"]
+        else:
+            # the project and its image may have been moved together
+            image_path = os.path.join(project_dir, image["relative"]) if "relative" in image else image["path"]
+            if not os.path.exists(image_path):
+                image_path = image["path"]
+
+    if deferred:
+        document = Document(image_path, deferred=True, data=data)
+    else:
+        document = Document(image_path, image=Image.open(BytesIO(data)) if data != None else None)
+    document.set_orientation(Orientation.from_name(image.get("orientation")))
+    document.scale = manifest.get("scale", document.scale)
+
+    # layers are only built from their specs: editors and layer images are created on first use
+    document.load_layers([layer_from_spec(document, spec) for spec in manifest.get("layers", [])])
+
+    document.project_path = path
+    document.image_modified = image.get("modified", False)
+    document.dirty = False
+
+    return document
+
+class DocumentSnapshot:
+    # everything needed to save a document away from the main thread, on its own copy of the stack
+
+    def __init__(self, document):
+        self.path = document.path
+        self.project_path = document.project_path
+        self.pixels = document.pixels
+        self.orientation = document.orientation
+        self.scale = document.scale
+        self.image_modified = document.image_modified
+        stack = list(reversed(list(document.layers)))
+        self.layers = [layer_to_spec(layer) for layer in stack]
+
+        # static clones save the pixels they display, not a capture of the stack at save time
+        self.clones = {i: layer.get_snapshot_surface() for i, layer in enumerate(stack) if isinstance(layer, layers.CloneAnnotationLayer) and layer.get_snapshot_surface() != None}
+
+    def matches(self, document):
+        # has the document been left untouched since the snapshot?
+        return document.pixels is self.pixels and document.orientation == self.orientation and self.layers == [layer_to_spec(layer) for layer in reversed(list(document.layers))]
+
+    def save(self):
+        # on the pixels of the displayed document, without any copy
+        document = Document(self.path, thumbnails=False, pixels=self.pixels)
+        document.set_orientation(self.orientation)
+        document.scale = self.scale
+        document.image_modified = self.image_modified
+        stack = [layer_from_spec(document, spec) for spec in self.layers]
+        for i, surface in self.clones.items():
+            stack[i].set_snapshot_surface(surface)
+        document.load_layers(stack)
+
+        document.save()
+
+        if self.project_path != None:
+            save_project(document, self.project_path)
+
+def benchmark(image_path, layers_count=1000, embed=False, path=None):
+    # save/load timings of a project with a large stack of layers
+    path = path if path != None else os.path.splitext(image_path)[0] + "_benchmark" + PROJECT_EXTENSION
+
+    document = Document(image_path, thumbnails=False, preview=False)
+    width, height = document.size
+
+    specs = []
+    for i in range(layers_count):
+        x, y = (i * 37) % width, (i * 53) % height
+        specs.append({"type": "LineAnnotationLayer", "properties": {"arrow": i % 2 == 0}, "anchors": [[x, y], [(x + 100) % width, (y + 60) % height]]})
+    document.load_layers([layer_from_spec(document, spec) for spec in specs])
+
+    start = time.perf_counter()
+    save_project(document, path, embed=embed)
+    save_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    load_project(path)
+    load_time = time.perf_counter() - start
+
+    return {
+        "layers": layers_count,
+        "bytes": os.path.getsize(path),
+        "save": save_time,
+        "load": load_time,
+    }
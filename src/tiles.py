@@ -0,0 +1,101 @@
+# tiles.py
+#
+# Copyright 2021 Brice MARTIN
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import OrderedDict
+import math
+
+# size (in pixels) of the square tiles
+TILE_SIZE = 512
+
+def tile_rect(tx, ty, width, height, tile_size=TILE_SIZE):
+    # rect of a tile, the last row and column of tiles being clipped to the image
+    x1, y1 = tx * tile_size, ty * tile_size
+    return x1, y1, min(x1 + tile_size, width), min(y1 + tile_size, height)
+
+def tiles_in_rect(rect, width, height, tile_size=TILE_SIZE):
+    x1, y1, x2, y2 = rect
+    tx1, ty1 = max(math.floor(x1 / tile_size), 0), max(math.floor(y1 / tile_size), 0)
+    tx2, ty2 = min(math.ceil(x2 / tile_size), math.ceil(width / tile_size)), min(math.ceil(y2 / tile_size), math.ceil(height / tile_size))
+
+    for ty in range(ty1, ty2):
+        for tx in range(tx1, tx2):
+            yield tx, ty
+
+def surface_bytes(surface):
+    return surface.get_stride() * surface.get_height()
+
+class TileCache:
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self._tiles = OrderedDict()
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def get(self, key):
+        surface = self._tiles.get(key)
+
+        if surface != None:
+            self._tiles.move_to_end(key)
+            self.hits += 1
+        else:
+            self.misses += 1
+
+        return surface
+
+    def put(self, key, surface):
+        self.remove(key)
+
+        self._tiles[key] = surface
+        self.size += surface_bytes(surface)
+
+        # evict the least recently used tiles (keeping at least the new one)
+        while self.size > self.budget and len(self._tiles) > 1:
+            _, evicted = self._tiles.popitem(last=False)
+            self.size -= surface_bytes(evicted)
+            self.evictions += 1
+
+    def remove(self, key):
+        surface = self._tiles.pop(key, None)
+        if surface != None:
+            self.size -= surface_bytes(surface)
+
+    def remove_if(self, predicate):
+        for key in [key for key in self._tiles if predicate(key)]:
+            self.remove(key)
+
+    def clear(self):
+        self._tiles.clear()
+        self.size = 0
+
+    def get_stats(self):
+        return {
+            "tiles": len(self._tiles),
+            "bytes": self.size,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
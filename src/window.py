@@ -16,6 +16,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from .document import Document
+from .project import PROJECT_EXTENSION, DocumentSnapshot, save_project, load_project
+from .memory import MemoryManager
 from .resize_dialog import ResizeDialog
 from .layer_editor import LayerEditor
 from .accelerator import Accelerator
@@ -31,9 +33,18 @@ from PIL import Image
 import functools, operator
 from urllib.parse import urlparse, unquote
 import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 MOUSE_SCROLL_FACTOR = 2.0
 
+# documents rendered and encoded concurrently by "Save all"
+SAVE_ALL_WORKERS = min(4, os.cpu_count() or 1)
+
+# images decoded concurrently when opening several files
+LOAD_WORKERS = min(4, os.cpu_count() or 1)
+
 @Gtk.Template(resource_path='/io/boite/imagine/window.ui')
 class ImagineWindow(Gtk.ApplicationWindow):
     __gtype_name__ = 'ImagineWindow'
@@ -52,6 +63,8 @@ class ImagineWindow(Gtk.ApplicationWindow):
     header_bar: Gtk.HeaderBar = Gtk.Template.Child()
     infobar: Gtk.InfoBar = Gtk.Template.Child()
     infobar_label: Gtk.Label = Gtk.Template.Child()
+    infobar_progress: Gtk.ProgressBar = Gtk.Template.Child()
+    infobar_cancel: Gtk.Button = Gtk.Template.Child()
     main_paned: Gtk.Paned = Gtk.Template.Child()
     scroll_area: Gtk.ScrolledWindow = Gtk.Template.Child()
     viewport: Gtk.Viewport = Gtk.Template.Child()
@@ -75,11 +88,20 @@ class ImagineWindow(Gtk.ApplicationWindow):
         self._browsing_prev_x = 0
         self._browsing_prev_y = 0
         self._skip_browse_signal = False
-        self._saving = False
+        self._interacting = False
         self.mouse_x = 0
         self.mouse_y = 0
         self.selected_layer: Layer = None
 
+        # background "Save all"
+        self._save_all_cancel: threading.Event = None
+
+        # background decoding of the opened images
+        self._loader = ThreadPoolExecutor(max_workers=LOAD_WORKERS)
+
+        # images of the inactive documents are released beyond the memory budget
+        self._memory = MemoryManager(ImagineWindow.USER_SETTINGS.get_int("memory-budget") * 1024 * 1024)
+
         # infobar
         self.infobar.set_revealed(False)
 
@@ -179,58 +201,93 @@ class ImagineWindow(Gtk.ApplicationWindow):
 
     def load(self, path):
         # check if the file is already opened
-        existing = [i for i, doc in enumerate(self.documents) if doc.path == path]
+        existing = [i for i, doc in enumerate(self.documents) if doc.path == path or doc.project_path == path]
 
         if len(existing) > 0:
             # select existing file which already opened
             self.documents_listbox.select_row(self.documents_listbox.get_row_at_index(existing[0]))
         else:
             # load new document
-            document = Document(path)
+            if os.path.splitext(path)[1].lower() == PROJECT_EXTENSION:
+                start = time.perf_counter()
+                try:
+                    document = load_project(path, deferred=True)
+                except (OSError, ValueError, KeyError) as e:
+                    self.display_message("Unable to open the project %s: %s" % (path, e), Gtk.MessageType.ERROR)
+                    return
+                self.display_message("Project loaded in %.3fs: %s" % (time.perf_counter() - start, path))
+            else:
+                document = Document(path, deferred=True)
+
+            # listed right away, decoded in the background
             self.documents.append(document)
+            future = self._loader.submit(document.decode)
+            future.add_done_callback(lambda f, d=document: GLib.idle_add(lambda: self._on_document_decoded(d, f)))
 
             # trigger bindings
             self.document = document
 
-    def _save(self, document=None):
-        if document == None: document = self.document
-        if document == None: return
+    def _on_document_decoded(self, document, future):
+        # closed while decoding?
+        found, position = self.documents.find(document)
+        if not found: return
+
+        try:
+            image, pixels = future.result()
+        except Exception as e:
+            if document == self.document:
+                self._switch_document()
+            self.documents.remove(position)
+            self.display_message("Unable to open %s: %s" % (document.path, e), Gtk.MessageType.ERROR)
+            return
 
-        def save_png(surface):
-            surface.write_to_png(path)
+        document.set_pixels(image, pixels)
 
-        def save_jpg(surface):
-            image = pil_from_cairo_surface(surface)
-            image.save(path, quality=90)
+        if document == self.document:
+            self.redraw()
 
-        width, height = document.image.size
+        self._enforce_memory_budget()
 
-        path = document.path
+    def _restore_document(self, document):
+        # decodes the evicted image of a document again, in the background
+        document.loading = True
+        future = self._loader.submit(document.pixels.load)
+        future.add_done_callback(lambda f, d=document: GLib.idle_add(lambda: self._on_document_restored(d, f)))
 
-        self._saving = True
+    def _on_document_restored(self, document, future):
+        document.loading = False
 
-        switcher = {
-            ".jpg": save_jpg,
-            ".jpeg": save_jpg,
-            ".png": save_png
-        }
+        try:
+            future.result()
+        except Exception as e:
+            self.display_message("Unable to reload %s: %s" % (document.path, e), Gtk.MessageType.ERROR)
 
-        with cairo.ImageSurface(cairo.FORMAT_RGB24, width, height) as surface:
-            context = cairo.Context(surface)
-            document.draw(self, context, self.mouse_x, self.mouse_y, helpers=False)
+        if document == self.document:
+            self.redraw()
 
-            # save
-            saver = switcher[document.extension]
-            if saver != None:
-                saver(surface)
-            else:
-                self.display_message("Unsupported file format: %s" % document.extension)
+    def _enforce_memory_budget(self):
+        # not while saving in the background: the saved snapshots share the pixels of the documents
+        if self._save_all_cancel == None:
+            self._memory.enforce(list(self.documents), keep=self.document)
 
-        self._saving = False
+    def _is_document_ready(self):
+        return self.document != None and not self.document.loading
 
-        document.dirty = False
+    def _save(self, document=None):
+        if document == None: document = self.document
+        if document == None or document.loading: return
 
-        self.display_message("File saved to: %s" % path)
+        try:
+            document.save()
+        except ValueError as e:
+            self.display_message(str(e), Gtk.MessageType.ERROR)
+            return
+
+        # keep the project of the document in sync
+        if document.project_path != None:
+            save_project(document, document.project_path)
+
+        self.display_message("File saved to: %s" % document.path)
 
     def _load_window_state(self):
         self.set_position(Gtk.WindowPosition.CENTER_ALWAYS)
@@ -248,7 +305,22 @@ class ImagineWindow(Gtk.ApplicationWindow):
 
     @delay(3.0)
     def hide_message(self):
-        self.infobar.set_revealed(False)
+        # keep the progress of a background save visible
+        if self._save_all_cancel == None:
+            self.infobar.set_revealed(False)
+
+    def display_progress(self, message, fraction):
+        self.infobar_label.set_text(message)
+        self.infobar_progress.set_fraction(fraction)
+        self.infobar_progress.set_text("%d%%" % (fraction * 100))
+        self.infobar_progress.set_visible(True)
+        self.infobar_cancel.set_visible(True)
+        self.infobar.set_message_type(Gtk.MessageType.INFO)
+        self.infobar.set_revealed(True)
+
+    def hide_progress(self):
+        self.infobar_progress.set_visible(False)
+        self.infobar_cancel.set_visible(False)
 
     @Gtk.Template.Callback("on_file_open")
     def on_file_open(self, widget):
@@ -262,6 +334,7 @@ class ImagineWindow(Gtk.ApplicationWindow):
         filter.add_pattern("*.png")
         filter.add_pattern("*.jpg")
         filter.add_pattern("*.jpeg")
+        filter.add_pattern("*" + PROJECT_EXTENSION)
         dialog.add_filter(filter)
 
         response = dialog.run()
@@ -278,7 +351,7 @@ class ImagineWindow(Gtk.ApplicationWindow):
 
     @Gtk.Template.Callback("on_file_save_as")
     def on_file_save_as(self, widget):
-        if self.document == None: return
+        if not self._is_document_ready(): return
 
         dialog = Gtk.FileChooserDialog("Save destination", self, Gtk.FileChooserAction.SAVE,
                                        (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL, Gtk.STOCK_SAVE_AS, Gtk.ResponseType.OK))
@@ -301,6 +374,36 @@ class ImagineWindow(Gtk.ApplicationWindow):
 
         dialog.destroy()
 
+    @Gtk.Template.Callback("on_file_save_project")
+    def on_file_save_project(self, widget):
+        if not self._is_document_ready(): return
+
+        dialog = Gtk.FileChooserDialog("Project destination", self, Gtk.FileChooserAction.SAVE,
+                                       (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL, Gtk.STOCK_SAVE_AS, Gtk.ResponseType.OK))
+
+        filter = Gtk.FileFilter()
+        filter.set_name("Projects")
+        filter.add_pattern("*" + PROJECT_EXTENSION)
+        dialog.add_filter(filter)
+
+        if self.document.project_path != None:
+            dialog.set_filename(self.document.project_path)
+        else:
+            dialog.set_current_name(os.path.splitext(self.document.name)[0] + PROJECT_EXTENSION)
+
+        response = dialog.run()
+
+        if response == Gtk.ResponseType.OK:
+            path = dialog.get_filename()
+            if not path.lower().endswith(PROJECT_EXTENSION):
+                path += PROJECT_EXTENSION
+
+            start = time.perf_counter()
+            save_project(self.document, path)
+            self.display_message("Project saved in %.3fs to: %s" % (time.perf_counter() - start, path))
+
+        dialog.destroy()
+
     @Gtk.Template.Callback("on_file_close")
     def on_file_close(self, widget):
         row = self.documents_listbox.get_selected_row()
@@ -323,13 +426,69 @@ class ImagineWindow(Gtk.ApplicationWindow):
 
             self._switch_document()
             self.documents.remove(index)
+            self._memory.forget(document)
 
     @Gtk.Template.Callback("on_file_save_all")
     def on_file_save_all(self, widget):
-        for document in self.documents:
-            self._save(document)
+        if self._save_all_cancel != None: return
+
+        # only the modified documents, each one saved from its own copy of the stack
+        jobs = [(document, DocumentSnapshot(document)) for document in self.documents if document.dirty]
+
+        if len(jobs) == 0:
+            self.display_message("No modified files to save.")
+            return
+
+        cancel = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=SAVE_ALL_WORKERS)
+        progress = {"done": 0, "saved": 0, "errors": []}
+
+        self._save_all_cancel = cancel
+        self.display_progress("Saving %d file(s)..." % len(jobs), 0)
+
+        def save(snapshot):
+            if cancel.is_set(): return False
+            snapshot.save()
+            return True
 
-        self.display_message("All modified files saved successfully.")
+        # main thread
+        def when_saved(document, snapshot, future):
+            progress["done"] += 1
+
+            if not future.cancelled():
+                try:
+                    if future.result():
+                        progress["saved"] += 1
+                        if snapshot.matches(document):
+                            document.dirty = False
+                except Exception as e:
+                    progress["errors"].append("%s (%s)" % (document.name, e))
+
+            if progress["done"] < len(jobs):
+                self.display_progress("Saving %d file(s)..." % len(jobs), progress["done"] / len(jobs))
+                return
+
+            executor.shutdown(wait=False)
+            self._save_all_cancel = None
+            self.hide_progress()
+            self._enforce_memory_budget()
+
+            if len(progress["errors"]) > 0:
+                self.display_message("Unable to save: %s" % ", ".join(progress["errors"]), Gtk.MessageType.ERROR)
+            elif cancel.is_set():
+                self.display_message("Saving cancelled: %d of %d file(s) saved." % (progress["saved"], len(jobs)), Gtk.MessageType.WARNING)
+            else:
+                self.display_message("All modified files saved successfully.")
+
+        for document, snapshot in jobs:
+            future = executor.submit(save, snapshot)
+            future.add_done_callback(lambda f, d=document, s=snapshot: GLib.idle_add(lambda: when_saved(d, s, f)))
+
+    @Gtk.Template.Callback("on_save_all_cancel")
+    def on_save_all_cancel(self, widget):
+        if self._save_all_cancel != None:
+            self._save_all_cancel.set()
+            self.infobar_label.set_text("Cancelling...")
 
     @Gtk.Template.Callback("on_zoom_changed")
     def on_zoom_changed(self, widget):
@@ -339,13 +498,14 @@ class ImagineWindow(Gtk.ApplicationWindow):
 
     @Gtk.Template.Callback("on_resize")
     def on_resize(self, widget):
+        if not self._is_document_ready(): return
 
         def handle_response(d, r):
             if r == Gtk.ResponseType.OK:
                 self.do_resize(d.width, d.height)
             d.destroy()
 
-        dialog = ResizeDialog(self.document.image.size[0], self.document.image.size[1])
+        dialog = ResizeDialog(self.document.size[0], self.document.size[1])
         dialog.set_transient_for(self) # link dialog to parent
 
         dialog.connect("response", handle_response)
@@ -414,21 +574,25 @@ class ImagineWindow(Gtk.ApplicationWindow):
 
     @Gtk.Template.Callback("on_rotate_left")
     def on_rotate_left(self, widget):
+        if not self._is_document_ready(): return
         self.document.rotate(90)
         self.redraw()
 
     @Gtk.Template.Callback("on_rotate_right")
     def on_rotate_right(self, widget):
+        if not self._is_document_ready(): return
         self.document.rotate(-90)
         self.redraw()
 
     @Gtk.Template.Callback("on_flip_horizontal")
     def on_flip_horizontal(self, widget):
+        if not self._is_document_ready(): return
         self.document.flip_horizontal()
         self.redraw()
 
     @Gtk.Template.Callback("on_flip_vertical")
     def on_flip_vertical(self, widget):
+        if not self._is_document_ready(): return
         self.document.flip_vertical()
         self.redraw()
 
@@ -438,6 +602,7 @@ class ImagineWindow(Gtk.ApplicationWindow):
 
     @Gtk.Template.Callback("on_zoom_best_fit")
     def on_zoom_best_fit(self, _):
+        if not self._is_document_ready(): return
         self.document.scale = self._get_best_fit_document_scale(self.document)
 
     @Gtk.Template.Callback("on_layer_button_press")
@@ -469,7 +634,7 @@ class ImagineWindow(Gtk.ApplicationWindow):
         dialog.destroy()
 
     def _get_best_fit_document_scale(self, document):
-        source_w, source_h = document.image.size
+        source_w, source_h = document.size
         target_w, target_h = self.scroll_area.get_allocated_width(), self.scroll_area.get_allocated_height()
 
         source_ratio = source_w / source_h
@@ -497,10 +662,18 @@ class ImagineWindow(Gtk.ApplicationWindow):
                 self.document = None # no more document in the stacky
 
     def create_layer(self, layer):
+        if not self._is_document_ready(): return
         self.document.add_layer(layer)
 
-    def redraw(self):
-        self.drawing_area.queue_draw()
+    def redraw(self, area=None):
+        if area == None or self.document == None:
+            self.drawing_area.queue_draw()
+        else:
+            # image to widget coordinates
+            scale = self.document.scale / 100
+            x1, y1 = math.floor(area[0] * scale), math.floor(area[1] * scale)
+            x2, y2 = math.ceil(area[2] * scale), math.ceil(area[3] * scale)
+            self.drawing_area.queue_draw_area(x1, y1, x2 - x1, y2 - y1)
 
     def _set_header_subtitle(self, subtitle):
         if subtitle != None:
@@ -510,7 +683,7 @@ class ImagineWindow(Gtk.ApplicationWindow):
             self.label_subtitle.hide()
 
     def mouse_move(self, w, event):
-        if self.document == None: return
+        if not self._is_document_ready(): return
 
         # browsing with the middle mouse button
         if self._browsing:
@@ -524,29 +697,42 @@ class ImagineWindow(Gtk.ApplicationWindow):
 
             self._browsing_prev_x = event.x
             self._browsing_prev_y = event.y
-        else:
+        elif self.selected_layer != None:
             # tooling
+            previous_helpers = self.selected_layer.get_helpers_bounds(self.mouse_x, self.mouse_y)
+
             self.mouse_x = event.x / (self.document.scale / 100)
             self.mouse_y = event.y / (self.document.scale / 100)
 
-            if self.selected_layer != None:
-                self.selected_layer.mouse_move(self.drawing_area, self.document.imageSurface, self.mouse_x, self.mouse_y)
+            self.selected_layer.mouse_move(self.drawing_area, None, self.mouse_x, self.mouse_y)
+
+            # only redraw the areas touched by the layer and its helpers
+            areas = previous_helpers + self.selected_layer.get_helpers_bounds(self.mouse_x, self.mouse_y) + [self.document.get_damaged_area(self._get_viewport())]
+            for area in areas:
+                if area != None:
+                    self.redraw(area)
+        else:
+            self.mouse_x = event.x / (self.document.scale / 100)
+            self.mouse_y = event.y / (self.document.scale / 100)
 
             self.redraw()
 
     def mouse_down(self, w, event):
-        if self.document == None: return
+        if not self._is_document_ready(): return
 
         self.mouse_x = event.x / (self.document.scale / 100)
         self.mouse_y = event.y / (self.document.scale / 100)
 
+        # fast rendering until the button is released
+        self._interacting = True
+
         if not self._browsing and event.button == 2:
             self._browsing_prev_x = event.x
             self._browsing_prev_y = event.y
             self._browsing = True
             self._remember_scroll_offset()
         elif self.selected_layer != None:
-            handled = self.selected_layer.mouse_down(self.drawing_area, self.document.imageSurface, self.mouse_x, self.mouse_y, event.button)
+            handled = self.selected_layer.mouse_down(self.drawing_area, None, self.mouse_x, self.mouse_y, event.button)
 
             if not handled:
                 # try to select another tool
@@ -557,18 +743,30 @@ class ImagineWindow(Gtk.ApplicationWindow):
         self.redraw()
 
     def mouse_up(self, w, event):
-        if self.document == None: return
+        if not self._is_document_ready(): return
 
         self.mouse_x = event.x / (self.document.scale / 100)
         self.mouse_y = event.y / (self.document.scale / 100)
 
+        # back to high quality rendering
+        self._interacting = False
+
         if self._browsing and event.button == 2:
             self._browsing = False
         elif self.selected_layer != None:
-            self.selected_layer.mouse_up(self.drawing_area, self.document.imageSurface, self.mouse_x, self.mouse_y, event.button)
+            self.selected_layer.mouse_up(self.drawing_area, None, self.mouse_x, self.mouse_y, event.button)
 
         self.redraw()
 
+    def _get_viewport(self):
+        # visible part of the document, in image coordinates
+        scale = self.document.scale / 100
+        adj_h = self.scroll_area.get_hadjustment()
+        adj_v = self.scroll_area.get_vadjustment()
+        x = adj_h.get_value() / scale
+        y = adj_v.get_value() / scale
+        return x, y, x + adj_h.get_page_size() / scale, y + adj_v.get_page_size() / scale
+
     def _offset_scroll_area(self, x, y, absolute=False):
         adj_h = self.scroll_area.get_hadjustment()
         ox = x if absolute else adj_h.get_value() + x
@@ -638,12 +836,15 @@ class ImagineWindow(Gtk.ApplicationWindow):
                 self.load(unquote(urlparse(uri).path))
 
     def on_drop_image(self, widget, drag_context, x, y, data, info, time):
-        if info == 80:
+        if info == 80 and self._is_document_ready():
             offset = 0
             for uri in data.get_uris():
                 path = unquote(urlparse(uri).path)
-                layer = ImageAnnotationLayer(self.document, x1=x+offset, y1=y+offset, x2=x+offset+192, y2=y+offset+192, path=path)
-                self.document.add_layer(layer)
+                x1, y1 = (x + offset) / (self.document.scale / 100), (y + offset) / (self.document.scale / 100)
+                layer = ImageAnnotationLayer(self.document, path=path)
+                layer.anchor1.set(x1, y1)
+                layer.anchor2.set(x1 + 192, y1 + 192)
+                self.create_layer(layer)
                 offset += 30
 
     def on_exit_app(self, widget, event):
@@ -683,6 +884,10 @@ class ImagineWindow(Gtk.ApplicationWindow):
         document.on_updated_thumbnail = on_updated_thumbnail
         box.pack_start(thumbnail, True, True, 0)
 
+        # spinning until the image is decoded
+        spinner = Gtk.Spinner()
+        box.pack_start(spinner, True, True, 0)
+
         # label
         label = Gtk.Label(label = document.name)
         document.bind_property("name", label, "label")
@@ -690,6 +895,8 @@ class ImagineWindow(Gtk.ApplicationWindow):
         box.pack_start(label, True, True, 0)
 
         box.show_all()
+        document.bind_property("loading", spinner, "active", GObject.BindingFlags.SYNC_CREATE)
+        document.bind_property("loading", spinner, "visible", GObject.BindingFlags.SYNC_CREATE)
         return box
 
     def _create_layer_item_widget(self, layer):
@@ -813,6 +1020,13 @@ class ImagineWindow(Gtk.ApplicationWindow):
         # switch document
         self.document = self.documents[row.get_index()] if len(self.documents) > 0 else None
 
+        # the most recently selected documents keep their pixels
+        if self.document != None:
+            self._memory.touch(self.document)
+            if self.document.evicted():
+                self._restore_document(self.document)
+            self._enforce_memory_budget()
+
         # bind
         self.layers_listbox.bind_model(self.document.layers, self._create_layer_item_widget)
 
@@ -882,21 +1096,27 @@ class ImagineWindow(Gtk.ApplicationWindow):
 
     def on_draw(self, w, cr):
 
-        # nothing to draw?
-        if self.document == None:
+        # nothing to draw (yet)?
+        if not self._is_document_ready():
             self.drawing_area.set_size_request(0, 0)
             return
 
         # scaling
-        iw, ih = self.document.image.size
-        if not self._saving:
-            w = (self.document.scale / 100) * iw
-            h = (self.document.scale / 100) * ih
-            self.drawing_area.set_size_request(w, h)
-            cr.scale(self.document.scale / 100, self.document.scale / 100)
-
-        # draw document
+        iw, ih = self.document.size
+        width = (self.document.scale / 100) * iw
+        height = (self.document.scale / 100) * ih
+        self.drawing_area.set_size_request(width, height)
+        cr.scale(self.document.scale / 100, self.document.scale / 100)
+
+        # only composite the visible part of the document
+        viewport = self._get_viewport()
+
+        # display zoomed out documents from the nearest pyramid level
+        level = self.document.get_pyramid_level()
+
+        # draw document (GTK clips the context to the queued areas)
+        filter = cairo.FILTER_FAST if self._interacting else cairo.FILTER_GOOD
         cr.save()
-        self.document.draw(w, cr, self.mouse_x, self.mouse_y, helpers=True)
+        self.document.draw(self.drawing_area, cr, self.mouse_x, self.mouse_y, helpers=True, viewport=viewport, level=level, filter=filter, interactive=self._interacting)
         cr.restore()
 
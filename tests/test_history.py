@@ -0,0 +1,127 @@
+# test_history.py
+#
+# Copyright 2021 Brice MARTIN
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+pytest.importorskip("gi")
+pytest.importorskip("cairo")
+
+from PIL import Image
+from src.document import Document
+from src.history import History, PixelData
+
+def noise(size=(64, 64)):
+    # (barely compressible)
+    return Image.merge('RGB', [Image.effect_noise(size, 80) for _ in range(3)])
+
+def spill_file_size(history):
+    history._spill_file.seek(0, 2)
+    return history._spill_file.tell()
+
+def test_pixel_data_round_trip(tmp_path):
+    image = noise()
+    data = PixelData(image, (8, 4, 40, 30))
+
+    assert data.origin == (8, 4)
+    assert data.get_image().tobytes() == image.crop((8, 4, 40, 30)).tobytes()
+
+    with open(tmp_path / "spill", "w+b") as first, open(tmp_path / "moved", "w+b") as second:
+        first.write(b"previous pixels")
+        data.spill(first)
+        assert data.spilled()
+        assert data.get_image().tobytes() == image.crop((8, 4, 40, 30)).tobytes()
+
+        data.move(second)
+        assert data.get_image().tobytes() == image.crop((8, 4, 40, 30)).tobytes()
+
+def test_snapshots_are_spilled_then_dropped():
+    history = History(memory_budget=30000, budget=70000)
+    images = [noise() for _ in range(10)]
+    restored = []
+
+    for i, image in enumerate(images):
+        data = PixelData(image)
+        history.snapshot("Step %d" % i, lambda data=data: restored.append(data.get_image()), [data])
+
+        stats = history.get_stats()
+        assert stats["memory"] <= history.memory_budget
+        assert stats["memory"] + stats["spilled"] <= history.budget
+
+    # the oldest ones are gone, the older ones on disk
+    stats = history.get_stats()
+    assert 1 < stats["snapshots"] < len(images)
+    assert stats["spilled"] > 0
+    assert not history.snapshots[0].data[0].spilled()
+    assert history.snapshots[stats["snapshots"] - 1].data[0].spilled()
+
+    # then rolled back to the exact pixels, most recent first
+    history.rollback(stats["snapshots"] - 1)
+    kept = images[len(images) - stats["snapshots"]:]
+    assert [image.tobytes() for image in restored] == [image.tobytes() for image in reversed(kept)]
+    assert history._spill_file == None
+
+def test_spill_file_is_compacted():
+    history = History(memory_budget=0, budget=40000)
+
+    for i in range(20):
+        history.snapshot("Step %d" % i, lambda: None, [PixelData(noise())])
+
+        # at most as many bytes of dropped snapshots as of remaining ones
+        live = history.get_stats()["spilled"]
+        assert spill_file_size(history) - live <= live
+
+    # the remaining pixels are read back from the new file
+    image = noise()
+    data = PixelData(image)
+    history.snapshot("Last", lambda: None, [data])
+    assert data.spilled()
+    assert data.get_image().tobytes() == image.tobytes()
+
+def test_last_snapshot_is_kept_beyond_the_budget():
+    history = History(memory_budget=0, budget=1)
+    image = noise()
+    data = PixelData(image)
+    restored = []
+
+    history.snapshot("Large", lambda: restored.append(data.get_image()), [data])
+    assert history.get_stats()["snapshots"] == 1
+
+    history.undo()
+    assert restored[0].tobytes() == image.tobytes()
+
+def test_crop_undo_restores_the_pixels():
+    image = noise((80, 60))
+    document = Document("image.png", image=image, thumbnails=False)
+
+    document.crop(10, 5, 50, 40)
+    assert document.size == (40, 35)
+    assert document.get_image().tobytes() == image.crop((10, 5, 50, 40)).tobytes()
+
+    document.history.undo()
+    assert document.size == (80, 60)
+    assert document.get_image().tobytes() == image.tobytes()
+
+def test_resize_undo_restores_the_pixels():
+    image = noise((80, 60))
+    document = Document("image.png", image=image, thumbnails=False)
+
+    document.resize(33, 21)
+    assert document.size == (33, 21)
+
+    document.history.undo()
+    assert document.size == (80, 60)
+    assert document.get_image().tobytes() == image.tobytes()
@@ -0,0 +1,98 @@
+# test_layers.py
+#
+# Copyright 2021 Brice MARTIN
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import pytest
+
+pytest.importorskip("gi")
+cairo = pytest.importorskip("cairo")
+
+from PIL import Image
+from gi.repository import GLib
+from src.document import Document
+from src.layers import EllipseAnnotationLayer, ImageAnnotationLayer, LightingLayer
+
+class DrawingArea:
+    # stands for the window drawing area: counts the queued redraws
+
+    def __init__(self):
+        self.draws = 0
+
+    def queue_draw(self):
+        self.draws += 1
+
+def draw(document, w):
+    width, height = document.size
+    cr = cairo.Context(cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height))
+    document.draw(w, cr, 0, 0)
+
+def test_completed_filter_evaluation_queues_a_redraw(tmp_path):
+    path = str(tmp_path / "image.png")
+    Image.new("RGB", (64, 64), (100, 150, 200)).save(path)
+
+    document = Document(path, thumbnails=False, preview=False)
+    layer = LightingLayer(document)
+    layer.anchor1.set(8, 8)
+    layer.anchor2.set(40, 40)
+    document.load_layers([layer])
+
+    w = DrawingArea()
+    draw(document, w)
+
+    # the result is handed back to the main loop
+    deadline = time.monotonic() + 10
+    while w.draws == 0 and time.monotonic() < deadline:
+        GLib.MainContext.default().iteration(False)
+        time.sleep(0.01)
+
+    assert w.draws == 1
+    assert layer.get_result_cache_stats()["tiles"] == 1
+
+    # then blitted from the cache, without any new evaluation
+    draw(document, w)
+    assert layer._job == None
+    assert layer.get_result_cache_stats()["hits"] >= 1
+
+def test_render_key_only_depends_on_the_rendering(tmp_path):
+    path = str(tmp_path / "image.png")
+    Image.new("RGB", (64, 64), (100, 150, 200)).save(path)
+
+    document = Document(path, thumbnails=False, preview=False)
+    layer = LightingLayer(document)
+    layer.anchor1.set(8, 8)
+    layer.anchor2.set(40, 40)
+    key = layer.get_render_key()
+
+    layer.name = "Renamed"
+    layer.position = 3
+    layer.active = True
+    assert layer.get_render_key() == key
+
+    layer.brightness = 2.0
+    assert layer.get_render_key() != key
+
+    # a persistent rect is drawn while the layer is being drawn too
+    ellipse = EllipseAnnotationLayer(document)
+    key = ellipse.get_render_key()
+    ellipse.dirty = not ellipse.dirty
+    assert ellipse.get_render_key() == key
+
+    # while an image is scaled on the fly
+    image = ImageAnnotationLayer(document)
+    key = image.get_render_key()
+    image.dirty = not image.dirty
+    assert image.get_render_key() != key
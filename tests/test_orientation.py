@@ -0,0 +1,112 @@
+# test_orientation.py
+#
+# Copyright 2021 Brice MARTIN
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+pytest.importorskip("gi")
+pytest.importorskip("cairo")
+
+from PIL import Image
+from src.document import Document
+from src.pixels import Orientation
+
+NAMES = [name for name, _ in Orientation.TRANSPOSITIONS.values()]
+
+def noise(size=(37, 23)):
+    return Image.merge('RGB', [Image.effect_noise(size, 80) for _ in range(3)])
+
+def test_names_round_trip():
+    assert Orientation.from_name(None).is_identity()
+    assert Orientation().get_name() == None
+
+    for name in NAMES:
+        assert Orientation.from_name(name).get_name() == name
+
+    with pytest.raises(ValueError):
+        Orientation.from_name("ROTATE_45")
+
+def test_compositions_back_to_identity():
+    rotation = Orientation.from_name("ROTATE_90")
+    orientation = Orientation()
+    for turns in range(4):
+        assert orientation.is_identity() == (turns == 0)
+        orientation = orientation.then(rotation)
+    assert orientation.is_identity()
+
+    for name in ("FLIP_LEFT_RIGHT", "FLIP_TOP_BOTTOM", "ROTATE_180", "TRANSPOSE", "TRANSVERSE"):
+        flip = Orientation.from_name(name)
+        assert flip.then(flip).is_identity()
+
+    for name in NAMES:
+        orientation = Orientation.from_name(name)
+        assert orientation.then(orientation.inverse()).is_identity()
+        assert orientation.inverse().then(orientation).is_identity()
+
+    # a mirror of a quarter turn
+    assert Orientation.from_name("ROTATE_90").then(Orientation.from_name("FLIP_LEFT_RIGHT")) == Orientation.from_name("TRANSVERSE")
+
+def test_transpositions_match_pil():
+    image = noise()
+
+    for name in NAMES:
+        orientation = Orientation.from_name(name)
+        transposed = orientation.transpose(image)
+        assert transposed.tobytes() == image.transpose(getattr(Image, name)).tobytes()
+        assert transposed.size == orientation.get_size(*image.size)
+
+        for other in NAMES:
+            composed = orientation.then(Orientation.from_name(other))
+            assert composed.transpose(image).tobytes() == Orientation.from_name(other).transpose(transposed).tobytes()
+
+def test_rects_follow_the_pixels():
+    image = noise()
+    rect = (3, 5, 20, 17)
+
+    for name in NAMES:
+        orientation = Orientation.from_name(name)
+        mapped = orientation.map_rect(rect, *image.size)
+        assert orientation.transpose(image.crop(rect)).tobytes() == orientation.transpose(image).crop(mapped).tobytes()
+        assert orientation.unmap_rect(mapped, *image.size) == rect
+
+def test_orientation_undo_restores_the_image():
+    image = noise()
+    document = Document("image.png", image=image, thumbnails=False)
+
+    document.rotate(90)
+    assert document.orientation.get_name() == "ROTATE_90"
+    assert document.size == (23, 37)
+    assert document.get_image().tobytes() == image.transpose(Image.ROTATE_90).tobytes()
+
+    document.flip_horizontal()
+    document.flip_vertical()
+    assert document.get_image().tobytes() == image.transpose(Image.ROTATE_270).tobytes()
+
+    for _ in range(3):
+        document.history.undo()
+    assert document.orientation.is_identity()
+    assert document.size == image.size
+    assert document.get_image().tobytes() == image.tobytes()
+
+def test_quarter_turns_keep_the_pixels():
+    image = noise()
+    document = Document("image.png", image=image, thumbnails=False)
+
+    for _ in range(4):
+        document.rotate(90)
+    assert document.orientation.is_identity()
+    assert document.get_image().tobytes() == image.tobytes()
+    assert not document.image_modified
@@ -0,0 +1,111 @@
+# test_pixels.py
+#
+# Copyright 2021 Brice MARTIN
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+pytest.importorskip("gi")
+cairo = pytest.importorskip("cairo")
+
+from PIL import Image, ImageChops
+from src.pixels import PixelStore, cairo_from_pil, file_signature, pil_from_cairo
+
+# odd width: the rows of the surfaces are padded to their stride
+SIZE = (37, 23)
+
+def noise(mode, size=SIZE):
+    return Image.merge(mode, [Image.effect_noise(size, 80) for _ in mode])
+
+def test_rgb_round_trip():
+    image = noise('RGB')
+    surface = cairo_from_pil(image)
+
+    assert surface.get_format() == cairo.FORMAT_RGB24
+    assert pil_from_cairo(surface).tobytes() == image.tobytes()
+
+def test_opaque_rgba_round_trip():
+    image = noise('RGB')
+    image.putalpha(255)
+    surface = cairo_from_pil(image)
+
+    assert surface.get_format() == cairo.FORMAT_ARGB32
+    assert pil_from_cairo(surface, 'RGBA').tobytes() == image.tobytes()
+
+def test_translucent_rgba_round_trip():
+    # premultiplied by alpha in the surface: exact for the transparent pixels, within a unit above half opacity
+    image = noise('RGB')
+    alpha = Image.effect_noise(SIZE, 80).point(lambda v: 128 + v // 2)
+    alpha.putpixel((0, 0), 0)
+    image.putalpha(alpha)
+    surface = cairo_from_pil(image)
+
+    r, g, b, a = image.getpixel((1, 0))
+    premultiplied = [int(round(v * a / 255)) for v in (b, g, r)]
+    data = surface.get_data()
+    assert all(abs(data[4 + i] - v) <= 1 for i, v in enumerate(premultiplied))
+    assert data[7] == a
+
+    decoded = pil_from_cairo(surface, 'RGBA')
+    assert decoded.getpixel((0, 0)) == (0, 0, 0, 0)
+    assert decoded.getchannel('A').tobytes() == alpha.tobytes()
+
+    decoded.putpixel((0, 0), image.getpixel((0, 0)))
+    assert max(e[1] for e in ImageChops.difference(decoded, image).getextrema()) <= 1
+
+def test_region_decoding():
+    image = noise('RGB')
+    surface = cairo_from_pil(image)
+
+    for rect in ((5, 3, 20, 15), (-4, -2, 10, 8), (30, 20, 45, 30), (40, 0, 50, 10)):
+        assert pil_from_cairo(surface, rect=rect).tobytes() == image.crop(rect).tobytes()
+
+@pytest.mark.parametrize("surface", [True, False])
+def test_evicted_pixels_are_restored_from_their_spill(surface):
+    image = noise('RGB', (64, 48))
+    store = PixelStore(image, surface=surface)
+
+    assert store.evict() > 0
+    assert store.evicted()
+    assert store.get_image().tobytes() == image.tobytes()
+    assert store.loaded()
+
+def test_evicted_translucent_pixels_are_restored_from_their_spill():
+    image = noise('RGBA', (64, 48))
+    store = PixelStore(image)
+    pixels = bytes(store.get_surface().get_data())
+
+    store.evict()
+    assert bytes(store.get_surface().get_data()) == pixels
+
+def test_evicted_pixels_are_decoded_again_from_their_file(tmp_path):
+    path = str(tmp_path / "image.png")
+    image = noise('RGB', (64, 48))
+    image.save(path)
+    store = PixelStore(Image.open(path), source=file_signature(path))
+
+    store.evict()
+    assert store.get_image().tobytes() == image.tobytes()
+
+def test_detached_pixels_are_not_decoded_again_from_their_file(tmp_path):
+    path = str(tmp_path / "image.png")
+    image = noise('RGB', (64, 48))
+    image.save(path)
+    store = PixelStore(Image.open(path), source=file_signature(path))
+
+    store.detach()
+    store.evict()
+    noise('RGB', (64, 48)).save(path)
+    assert store.get_image().tobytes() == image.tobytes()
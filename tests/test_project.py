@@ -0,0 +1,148 @@
+# test_project.py
+#
+# Copyright 2021 Brice MARTIN
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import zipfile
+import pytest
+
+pytest.importorskip("gi")
+pytest.importorskip("cairo")
+
+from PIL import Image
+from src.document import Document
+from src.project import PROJECT_MANIFEST, layer_from_spec, layer_to_spec, load_project, save_project
+
+SPECS = [
+    {"type": "TextAnnotationLayer", "properties": {"text": "Hello", "font": "Noto Serif Italic", "color": "rgba(255,0,0,0.5)"}, "anchors": [[10, 12]]},
+    {"type": "BlurLayer", "properties": {"quality": "Fast", "gaussian": 4.0}, "anchors": [[4, 6], [30, 20]]},
+    {"type": "LineAnnotationLayer", "properties": {"color": "rgb(0,128,255)", "arrow": True}, "anchors": [[1, 2], [40, 25]]},
+]
+
+def noise(size=(48, 32)):
+    return Image.merge('RGB', [Image.effect_noise(size, 80) for _ in range(3)])
+
+def create_document(path, image):
+    image.save(path)
+    document = Document(path, thumbnails=False, preview=False)
+    document.load_layers([layer_from_spec(document, spec) for spec in SPECS])
+    return document
+
+def read_manifest(path):
+    with zipfile.ZipFile(path) as archive:
+        return json.loads(archive.read(PROJECT_MANIFEST))
+
+def assert_same_document(loaded, document):
+    assert loaded.orientation == document.orientation
+    assert loaded.size == document.size
+    assert loaded.get_image().tobytes() == document.get_image().tobytes()
+    assert [layer_to_spec(layer) for layer in loaded.layers] == [layer_to_spec(layer) for layer in document.layers]
+
+def test_layer_properties_round_trip(tmp_path):
+    document = create_document(str(tmp_path / "image.png"), noise())
+    text, blur = document.layers[2], document.layers[1]
+
+    assert text.font.desc == "Noto Serif Italic"
+    assert (text.color.red, text.color.green, text.color.blue, text.color.alpha) == (1.0, 0.0, 0.0, 0.5)
+    assert blur.quality.value() == "Fast"
+    assert not text.dirty
+
+    specs = [layer_to_spec(layer) for layer in reversed(list(document.layers))]
+    assert [spec["type"] for spec in specs] == [spec["type"] for spec in SPECS]
+    assert specs[0]["properties"]["font"] == "Noto Serif Italic"
+    assert specs[1]["properties"]["quality"] == "Fast"
+    assert specs[2]["anchors"] == [[1, 2], [40, 25]]
+    assert all("dirty" not in spec["properties"] and "position" not in spec["properties"] for spec in specs)
+
+def test_referenced_image_round_trip(tmp_path):
+    document = create_document(str(tmp_path / "image.png"), noise())
+    document.rotate(90)
+    path = str(tmp_path / "project.imagine")
+    save_project(document, path)
+
+    image = read_manifest(path)["image"]
+    assert image["relative"] == "image.png"
+    assert image["orientation"] == "ROTATE_90"
+    assert "embedded" not in image
+
+    assert_same_document(load_project(path), document)
+
+def test_referenced_image_moved_with_its_project(tmp_path):
+    os.mkdir(tmp_path / "before")
+    document = create_document(str(tmp_path / "before" / "image.png"), noise())
+    save_project(document, str(tmp_path / "before" / "project.imagine"))
+
+    os.rename(tmp_path / "before", tmp_path / "after")
+    loaded = load_project(str(tmp_path / "after" / "project.imagine"))
+
+    assert loaded.path == str(tmp_path / "after" / "image.png")
+    assert_same_document(loaded, document)
+
+def test_embedded_image_round_trip(tmp_path):
+    document = create_document(str(tmp_path / "image.png"), noise())
+    document.flip_horizontal()
+    path = str(tmp_path / "project.imagine")
+    save_project(document, path, embed=True)
+    os.remove(tmp_path / "image.png")
+
+    image = read_manifest(path)["image"]
+    assert image["embedded"] == "image.png"
+    assert image["orientation"] == "FLIP_LEFT_RIGHT"
+    assert not image["modified"]
+
+    loaded = load_project(path)
+    assert_same_document(loaded, document)
+    assert not loaded.image_modified
+
+def test_modified_image_is_embedded(tmp_path):
+    document = create_document(str(tmp_path / "image.png"), noise())
+    document.crop(2, 3, 40, 30)
+    path = str(tmp_path / "project.imagine")
+    save_project(document, path)
+
+    image = read_manifest(path)["image"]
+    assert "embedded" in image and image["modified"]
+
+    loaded = load_project(path)
+    assert_same_document(loaded, document)
+    assert loaded.image_modified
+
+def test_deferred_load_keeps_the_orientation(tmp_path):
+    document = create_document(str(tmp_path / "image.png"), noise())
+    document.rotate(-90)
+    path = str(tmp_path / "project.imagine")
+    save_project(document, path)
+
+    loaded = load_project(path, deferred=True)
+    assert loaded.loading
+    loaded.set_pixels(*loaded.decode())
+
+    assert_same_document(loaded, document)
+
+def test_invalid_layers(tmp_path):
+    document = create_document(str(tmp_path / "image.png"), noise())
+
+    with pytest.raises(ValueError, match="Unknown layer type"):
+        layer_from_spec(document, {"type": "UnknownLayer"})
+    with pytest.raises(ValueError, match="Unknown layer type"):
+        layer_from_spec(document, {"type": "FilterLayer"})
+    with pytest.raises(ValueError, match="Too many anchors"):
+        layer_from_spec(document, {"type": "TextAnnotationLayer", "anchors": [[1, 1], [2, 2]]})
+    with pytest.raises(ValueError, match="Unknown property"):
+        layer_from_spec(document, {"type": "LineAnnotationLayer", "properties": {"font": "Sans"}})
+    with pytest.raises(ValueError, match="Invalid color"):
+        layer_from_spec(document, {"type": "LineAnnotationLayer", "properties": {"color": "not a color"}})